@@ -21,23 +21,703 @@ such it will contain some of but not all features that pygit2 offers.
 
 """
 
-import datetime
+import collections
 import errno
 import os
+import threading
+import time
 
 import pygit2
 
 import pygit2_utils.exceptions
+from pygit2_utils.cache import LRUCache
+from pygit2_utils.graph import CommitGraph
+from pygit2_utils.pool import RepoPool
+
+
+# The pool of repositories shared by the whole process
+DEFAULT_POOL = RepoPool()
+
+
+class RefSnapshot(object):
+    """ The references of a repository, read at once from its packed-refs
+    file, its loose references and its HEAD.
+
+    In a linked worktree, the references are read from the git directory
+    shared by all the worktrees and only HEAD from the one of the worktree.
+
+    - `refs`: the dictionary of the full name of each reference and the
+      hash of its target, or `ref: <name>` for symbolic references
+    - `peeled`: the dictionary of the full name of the tags and the hash of
+      the object they point to once peeled, as far as known from the
+      packed-refs file
+    - `head`: the content of HEAD, the hash of the commit checked-out or
+      `ref: <name>` of the branch checked-out
+    - `key`: the mtimes of the files and directories read, used to know if
+      the snapshot is still valid
+
+    """
+
+    def __init__(self, path, common_path=None):
+        """ Constructor of the RefSnapshot class.
+
+        :arg path: the path of the git directory of the repository
+        :type path: str
+        :kwarg common_path: the path of the git directory holding the
+            references, defaults to None in which case it is found from
+            the `commondir` file of linked worktrees, if any
+        :type common_path: str
+
+        """
+        self.path = path
+        if common_path is None:
+            common_path = self.common_dir(path)
+        self.common_path = common_path
+        # The key is computed first so that changes made while reading the
+        # references invalidate the snapshot
+        self.key = self.stat_key(path, common_path)
+        self.refs = {}
+        self.peeled = {}
+        self.head = None
+
+        self._read_packed_refs()
+        self._read_loose_refs()
+        try:
+            with open(os.path.join(path, 'HEAD')) as stream:
+                self.head = stream.read().strip()
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def common_dir(path):
+        """ Return the path of the git directory shared by the worktrees of
+        the repository whose git directory is at the specified path, which
+        is this path itself unless it belongs to a linked worktree.
+
+        """
+        try:
+            with open(os.path.join(path, 'commondir')) as stream:
+                common_path = stream.read().strip()
+        except (IOError, OSError):
+            return path
+        return os.path.normpath(os.path.join(path, common_path))
+
+    @staticmethod
+    def stat_key(path, common_path=None):
+        """ Return the mtimes of the packed-refs file, of HEAD and of the
+        directories holding the loose references of the repository at the
+        specified path.
+
+        """
+        if common_path is None:
+            common_path = path
+        refs_dir = os.path.join(common_path, 'refs')
+        paths = [
+            os.path.join(common_path, 'packed-refs'),
+            os.path.join(path, 'HEAD'),
+            refs_dir,
+        ]
+        for root, dirs, files in os.walk(refs_dir):
+            paths.extend(os.path.join(root, dirname) for dirname in dirs)
+        key = []
+        for filepath in paths:
+            try:
+                stat = os.stat(filepath)
+                key.append((filepath, stat.st_mtime, stat.st_size))
+            except OSError:
+                key.append((filepath, None, None))
+        return tuple(key)
+
+    def _read_packed_refs(self):
+        """ Read the references and the peeled targets of the tags from
+        the packed-refs file.
+
+        """
+        try:
+            with open(os.path.join(
+                    self.common_path, 'packed-refs')) as stream:
+                lines = stream.read().splitlines()
+        except (IOError, OSError):
+            return
+
+        # Unless the file says so, the tags without a peeled line may still
+        # be annotated tags
+        all_peeled = False
+        last = None
+        for line in lines:
+            if line.startswith('#'):
+                if ':' in line:
+                    all_peeled = 'peeled' in line.split(':', 1)[1].split()
+                continue
+            if line.startswith('^'):
+                if last is not None:
+                    self.peeled[last] = line[1:].strip()
+                continue
+            oid, last = line.split(' ', 1)
+            self.refs[last] = oid
+            if all_peeled and last.startswith('refs/tags/'):
+                self.peeled[last] = oid
+
+    def _read_loose_refs(self):
+        """ Read the loose references, which take precedence over the
+        packed ones.
+
+        """
+        for root, dirs, files in os.walk(
+                os.path.join(self.common_path, 'refs')):
+            for filename in files:
+                if filename.endswith('.lock'):
+                    continue
+                filepath = os.path.join(root, filename)
+                name = os.path.relpath(filepath, self.common_path)
+                name = name.replace(os.sep, '/')
+                try:
+                    with open(filepath) as stream:
+                        self.refs[name] = stream.read().strip()
+                except (IOError, OSError):
+                    continue
+                self.peeled.pop(name, None)
+
+    def resolve(self, name):
+        """ Return the hash of the target of the specified reference,
+        following the symbolic references, or None if it does not exist.
+
+        :arg name: the full name of the reference, or `HEAD`
+        :type name: str
+        :return: the hash of the object the reference points to
+        :rtype: str
+
+        """
+        seen = set()
+        while name not in seen:
+            seen.add(name)
+            if name == 'HEAD':
+                target = self.head
+            else:
+                target = self.refs.get(name)
+            if target is None or not target.startswith('ref: '):
+                return target
+            name = target[len('ref: '):]
+        return None
+
+    def names(self, prefix):
+        """ Return the sorted list of the full names of the references
+        starting with the specified prefix.
+
+        :arg prefix: the beginning of the names, for example `refs/tags/`
+        :type prefix: str
+        :return: the names of the references found
+        :rtype: list(str)
+
+        """
+        return sorted(name for name in self.refs if name.startswith(prefix))
+
+
+class StatusSnapshot(object):
+    """ The status of a working tree, as returned by a single scan of it.
+
+    Every path reported by the scan is sorted into the following buckets
+    (a path may be present in more than one of them):
+
+    - `modified`: tracked files changed locally
+    - `deleted`: tracked files removed locally
+    - `new`: files present locally but not tracked
+    - `staged`: files with changes added to the index
+    - `renamed`: files renamed, either in the index or locally
+    - `ignored`: files ignored by git
+
+    """
+
+    def __init__(self, status):
+        """ Constructor of the StatusSnapshot class.
+
+        :arg status: the status of the repository as returned by
+            `pygit2.Repository.status`
+        :type status: dict
+
+        """
+        self.flags = dict(status)
+        self.modified = []
+        self.deleted = []
+        self.new = []
+        self.staged = []
+        self.renamed = []
+        self.ignored = []
+
+        staged = pygit2.GIT_STATUS_INDEX_NEW \
+            | pygit2.GIT_STATUS_INDEX_MODIFIED \
+            | pygit2.GIT_STATUS_INDEX_DELETED \
+            | pygit2.GIT_STATUS_INDEX_RENAMED \
+            | pygit2.GIT_STATUS_INDEX_TYPECHANGE
+        renamed = pygit2.GIT_STATUS_INDEX_RENAMED \
+            | pygit2.GIT_STATUS_WT_RENAMED
+
+        for filepath, flag in self.flags.items():
+            if flag & pygit2.GIT_STATUS_WT_MODIFIED:
+                self.modified.append(filepath)
+            if flag & pygit2.GIT_STATUS_WT_DELETED:
+                self.deleted.append(filepath)
+            if flag & pygit2.GIT_STATUS_WT_NEW:
+                self.new.append(filepath)
+            if flag & staged:
+                self.staged.append(filepath)
+            if flag & renamed:
+                self.renamed.append(filepath)
+            if flag & pygit2.GIT_STATUS_IGNORED:
+                self.ignored.append(filepath)
+
+
+# The letter used by git to represent the status of a file in a diff
+DELTA_STATUS = {
+    pygit2.GIT_DELTA_ADDED: 'A',
+    pygit2.GIT_DELTA_DELETED: 'D',
+    pygit2.GIT_DELTA_MODIFIED: 'M',
+    pygit2.GIT_DELTA_RENAMED: 'R',
+    pygit2.GIT_DELTA_COPIED: 'C',
+    pygit2.GIT_DELTA_TYPECHANGE: 'T',
+    pygit2.GIT_DELTA_UNTRACKED: '?',
+}
+
+
+FileStat = collections.namedtuple(
+    'FileStat', ['path', 'status', 'additions', 'deletions', 'binary'])
+
+
+class DiffStats(object):
+    """ The summary of a diff: the files changed and the number of lines
+    added and removed.
+
+    - `files`: the list of `FileStat` for each file changed, holding its
+      `path`, its `status` as the letter git uses (`A`, `D`, `M`...), the
+      number of lines added (`additions`) and removed (`deletions`) and
+      whether it is a `binary` file
+    - `additions`: the total number of lines added
+    - `deletions`: the total number of lines removed
+
+    """
+
+    def __init__(self, diff):
+        """ Constructor of the DiffStats class.
+
+        :arg diff: the diff to summarize, can be None for an empty diff
+        :type diff: pygit2.Diff
+
+        """
+        self.files = []
+        self.additions = 0
+        self.deletions = 0
+
+        if diff is None:
+            return
+
+        for patch in diff:
+            delta = patch.delta
+            if delta.status == pygit2.GIT_DELTA_DELETED:
+                path = delta.old_file.path
+            else:
+                path = delta.new_file.path
+            _, additions, deletions = patch.line_stats
+            self.files.append(FileStat(
+                path, DELTA_STATUS.get(delta.status, 'X'),
+                additions, deletions, delta.is_binary))
+            self.additions += additions
+            self.deletions += deletions
+
+
+CommitRecord = collections.namedtuple(
+    'CommitRecord',
+    ['oid', 'subject', 'author_name', 'author_email', 'commit_time',
+     'parents'])
+
+
+class LogPage(list):
+    """ A page of the history of a repository: the list of the
+    `CommitRecord` of the page.
+
+    - `cursor`: the hashes of the commits not walked yet whose children
+      were, from which the walk resumes to get the next page, or None when
+      the whole history was walked
+
+    """
+
+    def __init__(self, commits=(), cursor=None):
+        """ Constructor of the LogPage class.
+
+        :kwarg commits: the commits of the page
+        :type commits: list(CommitRecord)
+        :kwarg cursor: the hashes of the commits from which to resume the
+            walk
+        :type cursor: list(str)
+
+        """
+        super(LogPage, self).__init__(commits)
+        self.cursor = cursor
+
+
+BranchRecord = collections.namedtuple(
+    'BranchRecord',
+    ['name', 'target', 'commit_time', 'author_name', 'author_email',
+     'upstream'])
+
+
+MergeCheck = collections.namedtuple('MergeCheck', ['status', 'conflicts'])
+
+
+RebaseResult = collections.namedtuple(
+    'RebaseResult', ['tip', 'commits', 'skipped'])
+
+
+DiffRecord = collections.namedtuple('DiffRecord', ['kind', 'path', 'content'])
+
+
+# The ways the diff of a merge commit can be computed
+MERGE_DIFF_MODES = ['first-parent', 'per-parent', 'combined']
+
+
+class MergeDiff(object):
+    """ The diff of a merge commit with its parents.
+
+    - `diffs`: the list of `pygit2.Diff` between each parent, in order,
+      and the merge commit
+    - `combined`: whether the diff is reduced to the changes that differ
+      from every parent
+
+    Like a `pygit2.Diff`, it offers a `patch` attribute and iterating over
+    it returns the `pygit2.Patch` of each file changed.
+    """
+
+    def __init__(self, diffs, combined=False):
+        """ Constructor of the MergeDiff class.
+
+        :arg diffs: the diffs between each parent and the merge commit
+        :type diffs: list(pygit2.Diff)
+        :kwarg combined: a boolean specifying whether to only keep the
+            changes that differ from every parent. Defaults to False.
+        :type combined: bool
+
+        """
+        self.diffs = diffs
+        self.combined = combined
+
+    def _combined_patches(self, skipped=()):
+        """ Return the list of tuples (delta, patch) of the first-parent
+        diff, patch being the `_CombinedPatch` keeping only its hunks that
+        also change lines compared to every other parent.
+
+        The diff of the files whose path is in `skipped` is not computed,
+        their patch is None.
+
+        """
+        others = []
+        for diff in self.diffs[1:]:
+            changed = {}
+            for idx, delta in enumerate(diff.deltas):
+                if delta.new_file.path in skipped:
+                    changed[delta.new_file.path] = None
+                    continue
+                patch = diff[idx]
+                lines = set()
+                starts = set()
+                for hunk in patch.hunks:
+                    starts.add(hunk.new_start)
+                    for line in hunk.lines:
+                        if line.origin == '+':
+                            lines.add(line.new_lineno)
+                changed[patch.delta.new_file.path] = (lines, starts)
+            others.append(changed)
+
+        patches = []
+        for idx, delta in enumerate(self.diffs[0].deltas):
+            path = delta.new_file.path
+            if any(path not in changed for changed in others):
+                continue
+            if path in skipped:
+                patches.append((delta, None))
+                continue
+            patch = self.diffs[0][idx]
+            if not patch.hunks:
+                patches.append((delta, _CombinedPatch(patch, None)))
+                continue
+
+            hunks = []
+            for hunk in patch.hunks:
+                added = set(
+                    line.new_lineno
+                    for line in hunk.lines
+                    if line.origin == '+')
+                if added:
+                    keep = all(
+                        added & changed[path][0] for changed in others)
+                else:
+                    # Only removals, keep them if the other parents also
+                    # differ at this position
+                    keep = all(
+                        hunk.new_start in changed[path][1]
+                        for changed in others)
+                if keep:
+                    hunks.append(hunk)
+            if hunks:
+                patches.append((delta, _CombinedPatch(patch, hunks)))
+
+        return patches
+
+    def __iter__(self):
+        if self.combined:
+            for _, patch in self._combined_patches():
+                yield patch
+        else:
+            for diff in self.diffs:
+                for patch in diff:
+                    yield patch
+
+    @property
+    def patch(self):
+        """ Return the diff as text.
+
+        In `combined` mode, only the hunks of the diff with the first parent
+        that also differ from the other parents are kept.
+        """
+        if not self.combined:
+            return ''.join(diff.patch or '' for diff in self.diffs)
+
+        return ''.join(
+            patch.text for _, patch in self._combined_patches())
+
+
+class _CombinedPatch(object):
+    """ A `pygit2.Patch` reduced to some of its hunks, as kept in the
+    combined diff of a merge commit.
+
+    It offers the `delta`, `hunks`, `line_stats` and `text` attributes of
+    the patch, computed from the hunks kept only.
+    """
+
+    def __init__(self, patch, hunks):
+        """ Constructor of the _CombinedPatch class.
+
+        :arg patch: the patch of the file changed
+        :type patch: pygit2.Patch
+        :arg hunks: the hunks of the patch to keep, None to keep the patch
+            as is (binary files...)
+        :type hunks: list(pygit2.DiffHunk)
+
+        """
+        self._patch = patch
+        self.delta = patch.delta
+        self.hunks = patch.hunks if hunks is None else hunks
+        self._filtered = hunks is not None
+
+    @property
+    def line_stats(self):
+        """ Return the tuple (context, additions, deletions) of the number
+        of lines in the hunks kept.
+        """
+        if not self._filtered:
+            return self._patch.line_stats
+        stats = {' ': 0, '+': 0, '-': 0}
+        for hunk in self.hunks:
+            for line in hunk.lines:
+                if line.origin in stats:
+                    stats[line.origin] += 1
+        return stats[' '], stats['+'], stats['-']
+
+    @property
+    def text(self):
+        """ Return the patch of the hunks kept as text. """
+        text = self._patch.text
+        if not self._filtered:
+            return text
+
+        # Keep the header of the patch, up to its first hunk
+        idx = text.find('\n@@ ')
+        output = [text[:idx + 1]]
+        for hunk in self.hunks:
+            output.append(hunk.header)
+            for line in hunk.lines:
+                if line.origin in [' ', '+', '-']:
+                    output.append(line.origin)
+                output.append(line.content)
+        return ''.join(output)
+
+
+class CommitBatch(object):
+    """ A series of commits written to the object database of a repository
+    on top of each other and moving the branch only once, when the batch is
+    done.
+
+    Use `GitRepo.commit_batch` to create one.
+    """
+
+    def __init__(self, gitrepo, branch='master', parent=None, username=None,
+                 useremail=None):
+        """ Constructor of the CommitBatch class.
+
+        :arg gitrepo: the repository in which to commit
+        :type gitrepo: GitRepo
+        :kwarg branch: the name of the branch to update. Defaults to
+            `master`
+        :type branch: str
+        :kwarg parent: the hash or reference of the commit on top of which
+            to stack the commits. Defaults to None, in which case the tip
+            of the branch is used, if it exists.
+        :type parent: str
+        :kwarg username: the username to use for the commits
+        :type username: str
+        :kwarg useremail: the email address to use for the commits
+        :type useremail: str
+        :raises KeyError: if the parent specified could not be found in the
+            repo
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            branch exists and the parent specified does not descend from its
+            tip, which would drop commits from the branch
+
+        """
+        self.gitrepo = gitrepo
+        self.ref = 'refs/heads/%s' % branch
+        self.username = username
+        self.useremail = useremail
+        self.commits = []
+
+        repository = gitrepo.repository
+        try:
+            self.old_target = repository.lookup_reference(
+                self.ref).resolve().target
+        except KeyError:
+            self.old_target = None
+
+        if parent is not None:
+            self.tip = repository.revparse_single(parent).oid
+            # Only fast-forward the branch, never rewind or fork it
+            if self.old_target is not None \
+                    and self.tip != self.old_target \
+                    and repository.merge_base(
+                        self.old_target, self.tip) != self.old_target:
+                raise pygit2_utils.exceptions.ReferenceChangedError()
+        else:
+            self.tip = self.old_target
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The commits made are left unreferenced if something went wrong
+        if exc_type is None:
+            self.finish()
+        return False
+
+    def commit(self, message, contents, username=None, useremail=None):
+        """ Commit the specified file contents on top of the previous commit
+        of the batch, without updating the branch.
+
+        :arg message: the message to use in the git commit
+        :type message: str
+        :arg contents: a dictionary of the paths of the files, relative to
+            the root of the repository, and of their new content as bytes or
+            as a file-like object. Files whose content is None are removed.
+        :type contents: dict
+        :kwarg username: the username to use for the commit, defaults to
+            the one of the batch
+        :type username: str
+        :kwarg useremail: the email address to use for the commit, defaults
+            to the one of the batch
+        :type useremail: str
+        :return: a `pygit2.Oid` object corresponding to the commit made
+        :rtype: pygit2.Oid
+
+        """
+        repository = self.gitrepo.repository
+
+        tree = None
+        parents = []
+        if self.tip is not None:
+            tree = repository[self.tip].tree
+            parents.append(self.tip)
+        treeid = self.gitrepo._write_contents(tree, contents)
+
+        author = self.gitrepo._signature(
+            username or self.username, useremail or self.useremail)
+
+        self.tip = repository.create_commit(
+            None, author, author, message, treeid, parents)
+        self.commits.append(self.tip)
+        return self.tip
+
+    def finish(self):
+        """ Move the branch to the last commit of the batch.
+
+        :return: a `pygit2.Oid` object corresponding to the new tip of the
+            branch, or None if nothing was committed
+        :rtype: pygit2.Oid
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            branch was moved since the batch was started
+
+        """
+        if not self.commits:
+            return None
+
+        self.gitrepo._move_ref(self.ref, self.old_target, self.tip)
+        self.old_target = self.tip
+        return self.tip
+
+
+CloneProgress = collections.namedtuple(
+    'CloneProgress',
+    ['received_objects', 'indexed_objects', 'total_objects',
+     'received_bytes', 'throughput'])
+
+
+def _normalize_config_key(configkey):
+    """ Return the configuration key with its section and variable names in
+    lower case, as git compares them.
+    """
+    parts = configkey.split('.')
+    parts[0] = parts[0].lower()
+    parts[-1] = parts[-1].lower()
+    return '.'.join(parts)
+
+
+class _ProgressCallbacks(pygit2.RemoteCallbacks):
+    """ The callbacks reporting the progress of a clone as `CloneProgress`
+    to the specified function.
+    """
+
+    def __init__(self, progress):
+        super(_ProgressCallbacks, self).__init__()
+        self.progress = progress
+        self.start = time.time()
+
+    def transfer_progress(self, stats):
+        elapsed = time.time() - self.start
+        throughput = 0.0
+        if elapsed > 0:
+            throughput = stats.received_bytes / elapsed
+        self.progress(CloneProgress(
+            stats.received_objects, stats.indexed_objects,
+            stats.total_objects, stats.received_bytes, throughput))
 
 
 class GitRepo(object):
     """ Generic interface to a git repository. """
 
-    def __init__(self, path):
+    def __init__(self, path, lazy=False, diff_cache=None,
+                 commit_graph=False):
         """ Constructor of the GitRepo class.
 
         :arg path: the path of the git repo on the filesystem. If not
             provided.
+        :kwarg lazy: a boolean specifying whether to defer opening the
+            repository and loading its configuration until they are first
+            used. Defaults to False.
+        :type lazy: bool
+        :kwarg diff_cache: the cache in which to keep the diffs computed
+            between commits, it can be shared between repositories.
+            Defaults to None, in which case the diffs are not cached.
+        :type diff_cache: LRUCache
+        :kwarg commit_graph: a boolean specifying whether to keep an index
+            of the generation numbers and parents of the commits next to the
+            repository, to speed up the reachability queries (is_ancestor,
+            merge_base, branches_containing). Defaults to False.
+        :type commit_graph: bool
 
         """
         if not os.path.isdir(path):
@@ -45,16 +725,110 @@ class GitRepo(object):
                 errno.ENOTDIR, '%s could not be found' % path)
 
         self.path = path
-        self.repository = pygit2.Repository(self.path)
-        self.config = self.repository.config
+        self._repository = None
+        self._config = None
+        self.diff_cache = diff_cache
+        self.use_commit_graph = commit_graph
+        self._commit_graph = None
+        self._divergence_cache = LRUCache(max_entries=1024)
+        self._merge_cache = LRUCache(max_entries=1024)
+
+        # Paths of the working tree whose mtime invalidates the cached
+        # status snapshot, defaults to the root of the working tree. When
+        # set, `files_changed` and `files_untracked` use the snapshot too.
+        self.status_watch = None
+        self._status_cache = None
+        self._config_cache = None
+        self._signature_cache = None
+        self._ref_cache = None
+        # Serializes the lazy opening of the repository, the configuration
+        # and the commit graph
+        self._open_lock = threading.RLock()
+
+        if not lazy:
+            self.config
+
+    def __getstate__(self):
+        """ Return the state of the object to pickle, the repository is
+        re-opened lazily once unpickled.
+        """
+        state = self.__dict__.copy()
+        state['_repository'] = None
+        state['_config'] = None
+        state['_commit_graph'] = None
+        state['_status_cache'] = None
+        state['_config_cache'] = None
+        state['_signature_cache'] = None
+        state['_ref_cache'] = None
+        del state['_open_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_lock = threading.RLock()
 
-        # If there is a local config, use it
-        potential_config = os.path.join(self.path, '.git', 'config')
-        if os.path.isfile(potential_config):
-            self.config.add_file(potential_config)
+    @property
+    def repository(self):
+        """ Return the `pygit2.Repository` object of the repo, opening it
+        if needed.
+
+        """
+        if self._repository is None:
+            with self._open_lock:
+                if self._repository is None:
+                    self._repository = pygit2.Repository(self.path)
+        return self._repository
+
+    @property
+    def commit_graph(self):
+        """ Return the `CommitGraph` index of the repo, loading it if
+        needed, or None if the repo does not use one.
+
+        """
+        if self.use_commit_graph and self._commit_graph is None:
+            with self._open_lock:
+                if self._commit_graph is None:
+                    self._commit_graph = CommitGraph(os.path.join(
+                        RefSnapshot.common_dir(self.repository.path),
+                        'pygit2_utils-commit-graph'))
+        return self._commit_graph
+
+    @property
+    def config(self):
+        """ Return the `pygit2.Config` object of the repo, loading it if
+        needed.
+
+        """
+        if self._config is None:
+            with self._open_lock:
+                if self._config is None:
+                    config = self.repository.config
+
+                    # If there is a local config, use it
+                    potential_config = os.path.join(
+                        self.path, '.git', 'config')
+                    if os.path.isfile(potential_config):
+                        config.add_file(potential_config)
+
+                    self._config = config
+        return self._config
+
+    @staticmethod
+    def _remote_head(repository, url, callbacks=None):
+        """ Return the name of the branch the HEAD of the remote repository
+        at the specified url points to.
+
+        """
+        remote = repository.remotes.create_anonymous(url)
+        for head in remote.ls_remotes(callbacks=callbacks):
+            if head['name'] == 'HEAD' and head['symref_target']:
+                return head['symref_target'].replace('refs/heads/', '', 1)
+        return 'master'
 
     @classmethod
-    def clone_repo(cls, url, dest_path, bare=False):
+    def clone_repo(cls, url, dest_path, bare=False, depth=None, branch=None,
+                   single_branch=False, local=True, reference=None,
+                   progress=None):
         """ Clone a git repo from the provided url at the specified dest_path.
 
         :arg url: the url of the git.
@@ -66,6 +840,32 @@ class GitRepo(object):
         :kwarg bare: a boolean specifying whether the cloned repo should be
             a bare repo or not
         :type bare: bool
+        :kwarg depth: the number of commits of history to fetch, for the
+            remotes supporting shallow clones. Defaults to None, in which
+            case the whole history is fetched.
+        :type depth: int
+        :kwarg branch: the name of the branch to check-out. Defaults to
+            None, in which case the branch HEAD points to in the remote repo
+            is used.
+        :type branch: str
+        :kwarg single_branch: a boolean specifying whether to only fetch the
+            branch to check-out. Defaults to False.
+        :type single_branch: bool
+        :kwarg local: a boolean specifying whether, when the url is a local
+            path, the objects of the repo are hardlinked (or copied if they
+            are on another filesystem) instead of being fetched.
+            Defaults to True.
+        :type local: bool
+        :kwarg reference: the path of a local repo whose objects are used by
+            the cloned repo (through its `objects/info/alternates` file)
+            instead of being fetched. The reference repo must then be kept.
+            Defaults to None.
+        :type reference: str
+        :kwarg progress: a function called with a `CloneProgress` as the
+            objects are fetched, holding the number of objects received,
+            indexed and to receive, the number of bytes received and the
+            throughput in bytes per second. Defaults to None.
+        :type progress: callable
         :return: a `GitRepo` object instanciated at the provided path
         :rtype: GitRepo
         :raises OSError: raised when the directory where is cloned the repo
@@ -78,28 +878,129 @@ class GitRepo(object):
             raise OSError(
                 errno.EEXIST, '%s exists and is not empty' % dest_path)
 
-        pygit2.clone_repository(url, dest_path, bare=bare)
+        kwargs = {}
+        if depth:
+            kwargs['depth'] = depth
+        if branch is not None:
+            kwargs['checkout_branch'] = branch
+        if progress is not None:
+            kwargs['callbacks'] = _ProgressCallbacks(progress)
+
+        # libgit2 hardlinks or copies all the objects of a repo cloned from a
+        # local path, with a file:// url they are fetched instead, which
+        # allows to skip those found in the reference repo
+        if (not local or reference is not None) and os.path.isdir(url):
+            url = 'file://%s' % os.path.abspath(url)
+
+        if reference is not None:
+            objects = os.path.join(
+                pygit2.Repository(reference).path, 'objects')
+
+            def _repository(path, bare):
+                repository = pygit2.init_repository(path, bare)
+                with open(os.path.join(
+                        repository.path, 'objects', 'info', 'alternates'),
+                        'w') as stream:
+                    stream.write('%s\n' % objects)
+                return repository
+
+            kwargs['repository'] = _repository
+
+        if single_branch:
+            def _remote(repository, name, url):
+                if isinstance(name, bytes):
+                    name = name.decode('utf-8')
+                if isinstance(url, bytes):
+                    url = url.decode('utf-8')
+                target = branch
+                if target is None:
+                    target = cls._remote_head(
+                        repository, url, kwargs.get('callbacks'))
+                return repository.remotes.create(
+                    name, url, '+refs/heads/%s:refs/remotes/%s/%s' % (
+                        target, name, target))
+
+            kwargs['remote'] = _remote
+
+        pygit2.clone_repository(url, dest_path, bare=bare, **kwargs)
 
         return cls(path=dest_path)
 
+    @classmethod
+    def open_pooled(cls, path, pool=None):
+        """ Return a `GitRepo` object for the repository at the specified
+        path, re-using the one opened previously if it is still in the pool.
+
+        :arg path: the path of the git repo on the filesystem
+        :type path: str
+        :kwarg pool: the pool of repositories to use. Defaults to None, in
+            which case the pool shared by the whole process is used.
+        :type pool: RepoPool
+        :return: a `GitRepo` object instanciated at the provided path
+        :rtype: GitRepo
+        :raises OSError: raised when the path provided is not a directory
+
+        """
+        if pool is None:
+            pool = DEFAULT_POOL
+        return pool.get(path, cls)
+
+    def ref_snapshot(self, refresh=False):
+        """ Return the references of the repo, reading them only once.
+
+        The snapshot is cached and re-used as long as neither the
+        packed-refs file, HEAD nor the directories holding the loose
+        references are modified. Checking this walks these directories, so
+        it is done once per method reading references.
+
+        :kwarg refresh: a boolean specifying whether to read the references
+            even if the cached snapshot is still valid
+        :type refresh: bool
+        :return: the references of the repo
+        :rtype: RefSnapshot
+
+        """
+        snapshot = self._ref_cache
+        if not refresh and snapshot is not None \
+                and snapshot.key == RefSnapshot.stat_key(
+                    snapshot.path, snapshot.common_path):
+            return snapshot
+
+        common_path = None
+        if snapshot is not None:
+            common_path = snapshot.common_path
+        self._ref_cache = RefSnapshot(self.repository.path, common_path)
+        return self._ref_cache
+
     @property
     def current_branch(self):
         """ Return the name of the current branch checked-out.
 
         """
-        head = self.repository.head
+        return self._current_branch(self.ref_snapshot())
 
-        return head.name.replace('refs/heads/', '')
+    @staticmethod
+    def _current_branch(snapshot):
+        """ Return the name of the branch checked-out according to the
+        specified snapshot of the references.
+
+        """
+        head = snapshot.head or ''
+        if not head.startswith('ref: '):
+            return 'HEAD'
+
+        return head[len('ref: '):].replace('refs/heads/', '')
 
     @property
     def remote_current_branch(self):
         """ Return the name of the remove of the current branch checked-out.
 
         """
-        branch = self.repository.lookup_branch(
-            self.repository.head.name.replace('refs/heads/', ''))
-        if branch.upstream:
-            return branch.upstream_name.replace('refs/remotes/', '')
+        snapshot = self.ref_snapshot()
+        upstream = self._upstream_ref(self._current_branch(snapshot))
+        if upstream is not None \
+                and snapshot.resolve(upstream) is not None:
+            return upstream.replace('refs/remotes/', '')
 
     @property
     def files_changed(self):
@@ -107,11 +1008,10 @@ class GitRepo(object):
         locally.
 
         """
-        status = self.repository.status()
-        files = []
-        for filepath, flag in status.items():
-            if (flag & pygit2.GIT_STATUS_WT_MODIFIED) \
-                    or (flag & pygit2.GIT_STATUS_WT_DELETED):
+        snapshot = self._current_status()
+        files = list(snapshot.modified)
+        for filepath in snapshot.deleted:
+            if filepath not in snapshot.modified:
                 files.append(filepath)
         return files
 
@@ -121,35 +1021,331 @@ class GitRepo(object):
         locally.
 
         """
-        status = self.repository.status()
-        files = []
-        for filepath, flag in status.items():
-            if flag & pygit2.GIT_STATUS_WT_NEW:
-                files.append(filepath)
-        return files
+        return list(self._current_status().new)
 
-    def get_config(self, configkey):
-        """ For a specified configuration key returned the value
-        corresponding to the setting in the configuration of the repo.
+    def _current_status(self):
+        """ Return the status of the working tree used by `files_changed`
+        and `files_untracked`: the cached snapshot if `status_watch` was set,
+        a new scan otherwise.
+
+        """
+        if self.status_watch is None:
+            return StatusSnapshot(self.repository.status())
+        return self.status_snapshot()
+
+    def _status_key(self):
+        """ Return the mtimes of the index file and of the watched paths of
+        the working tree, used to know if the cached status snapshot is
+        still valid.
+
+        """
+        paths = [os.path.join(self.repository.path, 'index')]
+        paths.extend(self.status_watch or [self.repository.workdir])
+        key = []
+        for path in paths:
+            try:
+                key.append(os.stat(path).st_mtime)
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    def status_snapshot(self, refresh=False):
+        """ Return the status of the working tree, scanning it only once.
+
+        The snapshot is cached and re-used as long as neither the index
+        file nor the paths listed in `status_watch` (by default the root of
+        the working tree) are modified.
+        Files edited in place, in a directory that is not watched, are not
+        detected until the cache is invalidated, use `refresh` to force a
+        new scan.
+
+        :kwarg refresh: a boolean specifying whether to scan the working
+            tree even if the cached snapshot is still valid
+        :type refresh: bool
+        :return: the status of the working tree
+        :rtype: StatusSnapshot
+
+        """
+        if not refresh and self._status_cache is not None:
+            key, snapshot = self._status_cache
+            if key == self._status_key():
+                return snapshot
+
+        snapshot = StatusSnapshot(self.repository.status())
+        # The key is computed after the scan since libgit2 may refresh the
+        # index while scanning
+        self._status_cache = (self._status_key(), snapshot)
+        return snapshot
+
+    def iter_status(self, pathspec=None, untracked='all'):
+        """ Yield the status of the files of the working tree, restricted
+        to the specified paths.
+
+        The working tree is scanned once by libgit2 and the result filtered,
+        only a pathspec naming a single file tracked in the index is checked
+        on its own. The whole scan is done before the first status is
+        yielded.
+
+        :kwarg pathspec: one or more paths, relative to the root of the
+            working tree, of files or directories to restrict the status to.
+            Defaults to None, in which case the whole working tree is
+            reported.
+        :type pathspec: str or list(str)
+        :kwarg untracked: how to report the untracked files.
+            Can be: `all` to report every untracked file, `normal` to report
+            untracked directories without recursing into them (their path
+            then ends with a `/`) or `no` to not report untracked files at
+            all. Defaults: `all`.
+        :type untracked: str
+        :return: a generator of tuples (path, flags) for each file that is
+            not up to date, the flags being a combination of
+            `pygit2.GIT_STATUS_*`. Ignored files are not reported.
+        :rtype: generator
+        :raises ValueError: when the untracked mode specified is not allowed
+
+        """
+        untracked_modes = ['all', 'normal', 'no']
+        if untracked not in untracked_modes:
+            raise ValueError('untracked is not in %s' % untracked_modes)
+
+        prefixes = None
+        if pathspec is not None:
+            if not isinstance(pathspec, list):
+                pathspec = [pathspec]
+            prefixes = [path.strip('/') for path in pathspec]
+
+        if prefixes is not None and len(prefixes) == 1 and prefixes[0] \
+                and prefixes[0] in self.repository.index:
+            # A single file tracked, which may also have been removed
+            try:
+                flag = self.repository.status_file(prefixes[0])
+            except (KeyError, ValueError):
+                # Replaced by a directory, let the scan report it
+                flag = None
+            if flag is not None:
+                if flag and flag != pygit2.GIT_STATUS_IGNORED:
+                    yield (prefixes[0], flag)
+                return
+
+        if untracked == 'all':
+            status = self.repository.status()
+        else:
+            status = self.repository.status(untracked_files=untracked)
+
+        def _match(path):
+            for prefix in prefixes:
+                if not prefix or path.rstrip('/') == prefix \
+                        or path.startswith(prefix + '/') \
+                        or (path.endswith('/') and prefix.startswith(path)):
+                    return True
+            return False
+
+        for path, flag in status.items():
+            if flag == pygit2.GIT_STATUS_IGNORED:
+                continue
+            if prefixes is None or _match(path):
+                yield (path, flag)
+
+    def list_files_changed(self, pathspec=None):
+        """ Return the list of files that are tracked in git and changed
+        locally, restricted to the specified paths.
+
+        :kwarg pathspec: one or more paths, relative to the root of the
+            working tree, of files or directories to restrict the search to.
+            Defaults to None, in which case the whole working tree is
+            searched.
+        :type pathspec: str or list(str)
+        :return: the list of files tracked and changed locally
+        :rtype: list(str)
+
+        """
+        if pathspec is None:
+            return self.files_changed
+
+        return [
+            filepath
+            for filepath, flag in self.iter_status(pathspec, untracked='no')
+            if (flag & pygit2.GIT_STATUS_WT_MODIFIED)
+            or (flag & pygit2.GIT_STATUS_WT_DELETED)
+        ]
+
+    def list_files_untracked(self, pathspec=None, recurse=True):
+        """ Return the list of files that are not tracked in git but present
+        locally, restricted to the specified paths.
+
+        :kwarg pathspec: one or more paths, relative to the root of the
+            working tree, of files or directories to restrict the search to.
+            Defaults to None, in which case the whole working tree is
+            searched.
+        :type pathspec: str or list(str)
+        :kwarg recurse: a boolean specifying whether to list the files in
+            the untracked directories or only the untracked directories
+            themselves (their path then ends with a `/`). Defaults to True.
+        :type recurse: bool
+        :return: the list of files not tracked but present locally
+        :rtype: list(str)
+
+        """
+        if pathspec is None and recurse:
+            return self.files_untracked
+
+        untracked = 'all' if recurse else 'normal'
+        return [
+            filepath
+            for filepath, flag in self.iter_status(pathspec, untracked)
+            if flag & pygit2.GIT_STATUS_WT_NEW
+        ]
+
+    def _config_files(self):
+        """ Return the paths of the configuration files that may be read
+        for this repository.
+
+        """
+        home = os.path.expanduser('~')
+        xdg_home = os.environ.get(
+            'XDG_CONFIG_HOME', os.path.join(home, '.config'))
+        return [
+            '/etc/gitconfig',
+            os.path.join(xdg_home, 'git', 'config'),
+            os.path.join(home, '.gitconfig'),
+            os.path.join(self.repository.path, 'config'),
+            os.path.join(
+                RefSnapshot.common_dir(self.repository.path), 'config'),
+            os.path.join(self.path, '.git', 'config'),
+        ]
+
+    def _config_snapshot(self):
+        """ Return the cache of the configuration values read so far.
+
+        The cache is emptied when one of the configuration files is
+        modified, created or removed.
+
+        """
+        key = []
+        for path in self._config_files():
+            try:
+                key.append(os.stat(path).st_mtime)
+            except OSError:
+                key.append(None)
+        key = tuple(key)
+
+        if self._config_cache is None or self._config_cache[0] != key:
+            self._config_cache = (key, {})
+        return self._config_cache[1]
+
+    def _read_config(self, configkey):
+        """ Return the value of the specified configuration key read from
+        the configuration of the repo.
 
-        :arg configkey: the configuration key to search for
-            (for example: "user.email" or "user.name")
-        :type configkey: str
-        :return: the setting corresponding to this key in the configuration
-        :rtype: str
         """
         value = None
         conf = self.config.get_multivar(configkey)
         if isinstance(conf, list) and len(conf) > 0:
             value = conf[0]
+        elif isinstance(conf, list):
+            raise KeyError(configkey)
         elif str(type(conf)) == "<class "\
                 "'pygit2.config.ConfigMultivarIterator'>":
             value = conf.next()
         else:
-            raise ('Unknown data format retrieved for %s: %s' % (
-                configkey, type(conf)))
+            raise pygit2_utils.exceptions.ConfigurationChangeError(
+                'Unknown data format retrieved for %s: %s' % (
+                    configkey, type(conf)))
         return value
 
+    def get_config(self, configkey):
+        """ For a specified configuration key returned the value
+        corresponding to the setting in the configuration of the repo.
+
+        The values are cached until the configuration files are changed.
+
+        :arg configkey: the configuration key to search for
+            (for example: "user.email" or "user.name")
+        :type configkey: str
+        :return: the setting corresponding to this key in the configuration
+        :rtype: str
+        :raises pygit2_utils.exceptions.ConfigurationChangeError: when the
+            value retrieved from pygit2 has an unknown format
+        """
+        snapshot = self._config_snapshot()
+        if configkey not in snapshot:
+            snapshot[configkey] = self._read_config(configkey)
+        return snapshot[configkey]
+
+    def get_config_many(self, configkeys):
+        """ For a list of configuration keys returned the values
+        corresponding to these settings in the configuration of the repo.
+
+        The keys not cached yet are read in a single pass over the
+        configuration.
+
+        :arg configkeys: the configuration keys to search for
+        :type configkeys: list(str)
+        :return: a dictionary of the settings corresponding to each key in
+            the configuration, keys that are not set are not returned
+        :rtype: dict
+        :raises pygit2_utils.exceptions.ConfigurationChangeError: when a
+            value retrieved from pygit2 has an unknown format
+        """
+        snapshot = self._config_snapshot()
+        missing = [key for key in configkeys if key not in snapshot]
+        if len(missing) == 1:
+            try:
+                snapshot[missing[0]] = self._read_config(missing[0])
+            except (KeyError, StopIteration, ValueError):
+                pass
+        elif missing:
+            # Read all the missing keys in a single pass over the
+            # configuration, the first value found for a key is the one
+            # get_multivar returns first
+            wanted = {}
+            for configkey in missing:
+                wanted.setdefault(_normalize_config_key(configkey), []).append(
+                    configkey)
+            for entry in self.config:
+                name = _normalize_config_key(getattr(entry, 'name', entry))
+                if name not in wanted:
+                    continue
+                value = getattr(entry, 'value', None)
+                if value is None:
+                    value = self.config[name]
+                for configkey in wanted.pop(name):
+                    snapshot[configkey] = value
+                if not wanted:
+                    break
+
+        values = {}
+        for configkey in configkeys:
+            if configkey in snapshot:
+                values[configkey] = snapshot[configkey]
+        return values
+
+    def _signature(self, username=None, useremail=None):
+        """ Return the `pygit2.Signature` to use for a commit or a tag,
+        using the configuration of the repo for the information not
+        provided.
+
+        The user name and email address found in the configuration are
+        resolved once per configuration snapshot, the signature itself is
+        created at each call since it records the current time.
+
+        """
+        if username is None or useremail is None:
+            snapshot = self._config_snapshot()
+            if self._signature_cache is None \
+                    or self._signature_cache[0] is not snapshot:
+                self._signature_cache = (snapshot, (
+                    self.get_config('user.name'),
+                    self.get_config('user.email'),
+                ))
+            default_name, default_email = self._signature_cache[1]
+            if username is None:
+                username = default_name
+            if useremail is None:
+                useremail = default_email
+
+        return pygit2.Signature(username, useremail)
+
     def commit(self, message, files, branch='master', username=None,
                useremail=None):
         """ Commmit the specified list of files with the provided commit
@@ -179,12 +1375,7 @@ class GitRepo(object):
         tree = self.repository.index.write_tree()
 
         # Set variables needed for the commit
-        if username is None:
-            username = self.get_config('user.name')
-        if useremail is None:
-            useremail = self.get_config('user.email')
-
-        author = pygit2.Signature(username, useremail)
+        author = self._signature(username, useremail)
 
         parent = None
         try:
@@ -213,7 +1404,165 @@ class GitRepo(object):
 
         return commit
 
-    def diff(self, commitid1=None, commitid2=None):
+    def _write_tree(self, tree, changes):
+        """ Write the tree resulting of applying the specified changes to
+        the specified tree and return its id, or None if the resulting tree
+        is empty.
+
+        :arg tree: the tree to which apply the changes, can be None
+        :type tree: pygit2.Tree
+        :arg changes: a dictionary of the paths relative to this tree and
+            the id of their new blob, or None if they are removed
+        :type changes: dict
+
+        """
+        if tree is None:
+            builder = self.repository.TreeBuilder()
+        else:
+            builder = self.repository.TreeBuilder(tree)
+
+        subchanges = {}
+        for path, blobid in changes.items():
+            if '/' in path:
+                name, subpath = path.split('/', 1)
+                subchanges.setdefault(name, {})[subpath] = blobid
+            elif blobid is None:
+                if builder.get(path) is not None:
+                    builder.remove(path)
+            else:
+                filemode = pygit2.GIT_FILEMODE_BLOB
+                entry = builder.get(path)
+                if entry is not None and entry.filemode in [
+                        pygit2.GIT_FILEMODE_BLOB_EXECUTABLE,
+                        pygit2.GIT_FILEMODE_LINK]:
+                    filemode = entry.filemode
+                builder.insert(path, blobid, filemode)
+
+        for name, changes in subchanges.items():
+            subtree = None
+            entry = builder.get(name)
+            if entry is not None \
+                    and entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                subtree = self.repository[entry.oid]
+            treeid = self._write_tree(subtree, changes)
+            if treeid is None:
+                if entry is not None:
+                    builder.remove(name)
+            else:
+                builder.insert(name, treeid, pygit2.GIT_FILEMODE_TREE)
+
+        if len(builder) == 0:
+            return None
+        return builder.write()
+
+    def _write_contents(self, tree, contents):
+        """ Write the blobs of the specified contents and the tree resulting
+        of applying them to the specified tree, return the id of this tree.
+
+        """
+        changes = {}
+        for path, content in contents.items():
+            path = path.strip('/')
+            if content is None:
+                changes[path] = None
+                continue
+            if hasattr(content, 'read'):
+                content = content.read()
+            changes[path] = self.repository.create_blob(content)
+
+        treeid = self._write_tree(tree, changes)
+        if treeid is None:
+            treeid = self.repository.TreeBuilder().write()
+        return treeid
+
+    def commit_batch(self, branch='master', parent=None, username=None,
+                     useremail=None):
+        """ Return a `CommitBatch` to stack many commits on top of each
+        other and update the specified branch only once, at the end.
+
+        To be used as a context manager::
+
+            with repo.commit_batch('master') as batch:
+                batch.commit('First commit', {'foo': b'foo'})
+                batch.commit('Second commit', {'bar': b'bar'})
+
+        :kwarg branch: the name of the branch to update. Defaults to
+            `master`
+        :type branch: str
+        :kwarg parent: the hash or reference of the commit on top of which
+            to stack the commits. Defaults to None, in which case the tip
+            of the specified branch is used, if it exists. When the branch
+            exists, the parent must descend from its tip.
+        :type parent: str
+        :kwarg username: the username to use for the commits
+        :type username: str
+        :kwarg useremail: the email address to use for the commits
+        :type useremail: str
+        :return: the batch of commits
+        :rtype: CommitBatch
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            parent specified does not descend from the tip of the branch
+
+        """
+        return CommitBatch(
+            self, branch=branch, parent=parent, username=username,
+            useremail=useremail)
+
+    def commit_contents(self, message, contents, parent=None,
+                        branch='master', username=None, useremail=None):
+        """ Commit the specified file contents with the provided commit
+        message, without using the working tree nor the index of the repo.
+
+        This works on bare repositories as well.
+
+        :arg message: the message to use in the git commit
+        :type message: str
+        :arg contents: a dictionary of the paths of the files, relative to
+            the root of the repository, and of their new content as bytes or
+            as a file-like object. Files whose content is None are removed.
+        :type contents: dict
+        :kwarg parent: the hash or reference of the commit on top of which
+            to commit. Defaults to None, in which case the tip of the
+            specified branch is used, if it exists.
+        :type parent: str
+        :kwarg branch: the name of the branch to update, if None no branch
+            is updated. Defaults to `master`
+        :type branch: str
+        :kwarg username: the username to use for the commit
+        :type username: str
+        :kwarg useremail: the email address to use for the commit
+        :type useremail: str
+        :return: a `pygit2.Oid` object corresponding to the commit made
+        :rtype: pygit2.Oid
+        :raises KeyError: if the parent specified could not be found in the
+            repo
+
+        """
+        ref = None
+        if branch is not None:
+            ref = 'refs/heads/%s' % branch
+
+        parents = []
+        if parent is not None:
+            parents.append(self.repository.revparse_single(parent).oid)
+        elif ref is not None:
+            try:
+                parents.append(self.repository.lookup_reference(
+                    ref).resolve().target)
+            except KeyError:
+                pass
+
+        tree = None
+        if parents:
+            tree = self.repository[parents[0]].tree
+        treeid = self._write_contents(tree, contents)
+
+        author = self._signature(username, useremail)
+
+        return self.repository.create_commit(
+            ref, author, author, message, treeid, parents)
+
+    def diff(self, commitid1=None, commitid2=None, merge_diff_mode=None):
         """ Returns the diff of commit(s).
 
         If no commits are given, the method returns the diff between HEAD
@@ -224,14 +1573,320 @@ class GitRepo(object):
         If two commits are specified, the method returns the diff between
         the two commits.
 
+        The diff of a single merge commit depends on `merge_diff_mode`:
+
+        - None: an empty string is returned
+        - `first-parent`: the diff with its first parent
+        - `per-parent`: a `MergeDiff` holding the diff with each parent
+        - `combined`: a `MergeDiff` only showing the changes that differ
+          from every parent (like `git show --cc`, but in the format of a
+          diff with the first parent)
+
+        :kwarg commitid1: hash of the first commit to use (the oldest one).
+            Can be None.
+        :type commitid1: str
+        :kwarg commitid2: hash of the second commit to use (the most recent).
+            Can be None
+        :type commitid2: str
+        :kwarg merge_diff_mode: how to compute the diff of a merge commit.
+            Can be: `first-parent`, `per-parent`, `combined`.
+            Defaults to None.
+        :type merge_diff_mode: str
+        :return: the diff of the specified commits or with the current HEAD.
+        :rtype: str
+        :raises ValueError: if a single commit id is provided but is too
+            short, or when the merge diff mode specified is not allowed
+        :raises NoSuchRefError: if a single commit id is provided but does
+            not correspond to any commit
+        :raises KeyError: if two commits are provided and at least one of
+            them could not be found in the repo
+
+        """
+        if merge_diff_mode is not None \
+                and merge_diff_mode not in MERGE_DIFF_MODES:
+            raise ValueError(
+                'merge_diff_mode is not in %s' % MERGE_DIFF_MODES)
+
+        if commitid1 is None and commitid2 is None:
+            diff = self.repository.diff()
+        elif None in [commitid1, commitid2]:
+            commitid = [
+                el
+                for el in [commitid1, commitid2]
+                if el is not None
+            ][0]
+            commit = self.repository.get(commitid)
+            if commit is None:
+                 raise pygit2_utils.exceptions.NoSuchRefError()
+            if len(commit.parents) > 1:
+                if merge_diff_mode is None:
+                    diff = ''
+                elif merge_diff_mode == 'first-parent':
+                    diff = self.repository.diff(commit.parents[0], commit)
+                else:
+                    diff = MergeDiff(
+                        [
+                            self.repository.diff(parent, commit)
+                            for parent in commit.parents
+                        ],
+                        combined=merge_diff_mode == 'combined')
+            elif len(commit.parents) == 1:
+                parent = self.repository.revparse_single('%s^' % commitid)
+                diff = self.repository.diff(parent, commit)
+            else:
+                # First commit in the repo
+                diff = commit.tree.diff_to_tree(swap=True)
+        else:
+            c_t0 = self.repository.revparse_single(commitid1)
+            c_t1 = self.repository.revparse_single(commitid2)
+            diff = self.repository.diff(c_t0, c_t1)
+
+        return diff
+
+    def _blob_size(self, diff_file):
+        """ Return the size of the specified side of a diff, reading only
+        the object database or the working tree.
+
+        The diffs between trees do not report the size of the files, which
+        is then read by loading the blob from the object database.
+
+        """
+        if diff_file.size:
+            return diff_file.size
+        try:
+            return self.repository[diff_file.id].size
+        except (KeyError, ValueError):
+            pass
+        if self.repository.workdir:
+            try:
+                return os.path.getsize(
+                    os.path.join(self.repository.workdir, diff_file.path))
+            except OSError:
+                pass
+        return 0
+
+    def _iter_diff_patches(self, diff, max_blob_size):
+        """ Yield tuples (delta, patch, size) for each file of the
+        specified diff, patch being None when one side of the file is larger
+        than `max_blob_size`, in which case its diff is not computed and
+        size is the size of its largest side.
+
+        Checking the size of a file loads its blobs, see `_blob_size`, this
+        is only done once per side of the file.
+
+        """
+        sizes = {}
+
+        def _size(delta):
+            """ Return the size of the largest side of the file changed. """
+            size = 0
+            for diff_file in [delta.old_file, delta.new_file]:
+                key = (diff_file.id, diff_file.path)
+                if key not in sizes:
+                    sizes[key] = self._blob_size(diff_file)
+                size = max(size, sizes[key])
+            return size
+
+        if isinstance(diff, MergeDiff) and diff.combined:
+            # The diffs with each parent are computed to be combined, their
+            # patches only hold the hunks kept. A file too large with one of
+            # the parents is skipped with all of them.
+            skipped = {}
+            if max_blob_size is not None:
+                for parent_diff in diff.diffs:
+                    for delta in parent_diff.deltas:
+                        size = _size(delta)
+                        path = delta.new_file.path
+                        if size > max_blob_size:
+                            skipped[path] = max(size, skipped.get(path, 0))
+            for delta, patch in diff._combined_patches(skipped):
+                yield delta, patch, skipped.get(delta.new_file.path)
+            return
+
+        diffs = [diff]
+        if isinstance(diff, MergeDiff):
+            diffs = diff.diffs
+        for parent_diff in diffs:
+            for idx, delta in enumerate(parent_diff.deltas):
+                if max_blob_size is not None:
+                    size = _size(delta)
+                    if size > max_blob_size:
+                        yield delta, None, size
+                        continue
+                yield delta, parent_diff[idx], None
+
+    def iter_diff(self, commitid1=None, commitid2=None, max_file_lines=None,
+                  max_file_bytes=None, max_lines=None, max_bytes=None,
+                  max_blob_size=None, merge_diff_mode=None):
+        """ Yield the diff of commit(s) file by file, hunk by hunk and line
+        by line, computing the diff of each file only when it is reached.
+
+        The commits are handled as in the `diff` method.
+
+        The records yielded are `DiffRecord` tuples (kind, path, content):
+
+        - `file`: a file changed, the content is its status (`A`, `D`,
+          `M`...)
+        - `binary`: the file changed is binary, the content is None
+        - `skipped`: the file is larger than `max_blob_size` and was not
+          diffed, the content is its size
+        - `hunk`: a hunk of the file, the content is its header
+        - `line`: a line of the hunk, the content is the line as it appears
+          in a patch
+        - `truncated`: the remaining lines of the file (content: `file`) or
+          of the whole diff (content: `total`) are not returned since a
+          limit was reached
+
+        :kwarg commitid1: hash of the first commit to use (the oldest one).
+            Can be None.
+        :type commitid1: str
+        :kwarg commitid2: hash of the second commit to use (the most recent).
+            Can be None
+        :type commitid2: str
+        :kwarg max_file_lines: the maximum number of lines returned per
+            file. Defaults to None.
+        :type max_file_lines: int
+        :kwarg max_file_bytes: the maximum number of bytes of the lines
+            returned per file. Defaults to None.
+        :type max_file_bytes: int
+        :kwarg max_lines: the maximum number of lines returned in total.
+            Defaults to None.
+        :type max_lines: int
+        :kwarg max_bytes: the maximum number of bytes of the lines returned
+            in total. Defaults to None.
+        :type max_bytes: int
+        :kwarg max_blob_size: the size, in bytes, above which the content
+            of a file is not diffed. Defaults to None.
+        :type max_blob_size: int
+        :kwarg merge_diff_mode: how to compute the diff of a merge commit,
+            see `diff`. Defaults to None.
+        :type merge_diff_mode: str
+        :return: a generator of the records of the diff
+        :rtype: generator
+        :raises ValueError: if a single commit id is provided but is too
+            short
+        :raises NoSuchRefError: if a single commit id is provided but does
+            not correspond to any commit
+        :raises KeyError: if two commits are provided and at least one of
+            them could not be found in the repo
+
+        """
+        diff = self.diff(commitid1, commitid2, merge_diff_mode)
+        if diff == '':
+            return
+
+        def _exceeds(value, limit):
+            return limit is not None and value > limit
+
+        total_lines = total_bytes = 0
+        for delta, patch, size in self._iter_diff_patches(
+                diff, max_blob_size):
+            if delta.status == pygit2.GIT_DELTA_DELETED:
+                path = delta.old_file.path
+            else:
+                path = delta.new_file.path
+            yield DiffRecord(
+                'file', path, DELTA_STATUS.get(delta.status, 'X'))
+
+            if patch is None:
+                yield DiffRecord('skipped', path, size)
+                continue
+            if patch.delta.is_binary:
+                yield DiffRecord('binary', path, None)
+                continue
+
+            file_lines = file_bytes = 0
+            for hunk in patch.hunks:
+                yield DiffRecord('hunk', path, hunk.header)
+                for line in hunk.lines:
+                    content = line.content
+                    if line.origin in [' ', '+', '-']:
+                        content = line.origin + content
+
+                    file_lines += 1
+                    file_bytes += len(content)
+                    total_lines += 1
+                    total_bytes += len(content)
+                    if _exceeds(total_lines, max_lines) \
+                            or _exceeds(total_bytes, max_bytes):
+                        yield DiffRecord('truncated', None, 'total')
+                        return
+                    if _exceeds(file_lines, max_file_lines) \
+                            or _exceeds(file_bytes, max_file_bytes):
+                        yield DiffRecord('truncated', path, 'file')
+                        break
+
+                    yield DiffRecord('line', path, content)
+                else:
+                    continue
+                break
+
+    def _diff_key(self, kind, commitid1=None, commitid2=None,
+                  merge_diff_mode=None):
+        """ Return the key identifying in the diff cache the diff of the
+        specified commits, None if this diff cannot be cached.
+
+        The diff of a single commit is the diff between its parent and
+        itself, so both are stored under the same key.
+
+        :arg kind: the kind of result stored (patch, stats...)
+        :type kind: str
+        :kwarg commitid1: hash of the first commit to use (the oldest one).
+            Can be None.
+        :type commitid1: str
+        :kwarg commitid2: hash of the second commit to use (the most recent).
+            Can be None
+        :type commitid2: str
+        :kwarg merge_diff_mode: how the diff of a merge commit is computed
+        :type merge_diff_mode: str
+
+        """
+        if self.diff_cache is None:
+            return None
+        # The working tree changes
+        if commitid1 is None and commitid2 is None:
+            return None
+
+        try:
+            if None in [commitid1, commitid2]:
+                commit = self.repository.get(commitid1 or commitid2)
+                if commit is None:
+                    return None
+                parent = None
+                if len(commit.parents) == 1:
+                    parent = commit.parents[0].oid.hex
+                elif len(commit.parents) > 1:
+                    kind = '%s:%s' % (kind, merge_diff_mode)
+                return (parent, commit.oid.hex, kind)
+            else:
+                return (
+                    self.repository.revparse_single(commitid1).oid.hex,
+                    self.repository.revparse_single(commitid2).oid.hex,
+                    kind,
+                )
+        except (KeyError, ValueError):
+            # Let the diff itself report the error
+            return None
+
+    def diff_stats(self, commitid1=None, commitid2=None,
+                   merge_diff_mode=None):
+        """ Returns the summary of the diff of commit(s), without rendering
+        the patch itself.
+
+        The commits are handled as in the `diff` method.
+
         :kwarg commitid1: hash of the first commit to use (the oldest one).
             Can be None.
         :type commitid1: str
         :kwarg commitid2: hash of the second commit to use (the most recent).
             Can be None
         :type commitid2: str
-        :return: the diff of the specified commits or with the current HEAD.
-        :rtype: str
+        :kwarg merge_diff_mode: how to compute the diff of a merge commit,
+            see `diff`. Defaults to None.
+        :type merge_diff_mode: str
+        :return: the files changed and the number of lines added and removed
+            in the specified commits or with the current HEAD.
+        :rtype: DiffStats
         :raises ValueError: if a single commit id is provided but is too
             short
         :raises NoSuchRefError: if a single commit id is provided but does
@@ -240,70 +1895,586 @@ class GitRepo(object):
             them could not be found in the repo
 
         """
-        if commitid1 is None and commitid2 is None:
-            diff = self.repository.diff()
-        elif None in [commitid1, commitid2]:
-            commitid = [
-                el
-                for el in [commitid1, commitid2]
-                if el is not None
-            ][0]
-            commit = self.repository.get(commitid)
-            if commit is None:
-                 raise pygit2_utils.exceptions.NoSuchRefError()
-            if len(commit.parents) > 1:
-                diff = ''
-            elif len(commit.parents) == 1:
-                parent = self.repository.revparse_single('%s^' % commitid)
-                diff = self.repository.diff(parent, commit)
+        key = self._diff_key(
+            'stats', commitid1, commitid2, merge_diff_mode)
+        if key is not None and self.diff_cache is not None:
+            stats = self.diff_cache.get(key)
+            if stats is not None:
+                return stats
+
+        diff = self.diff(commitid1, commitid2, merge_diff_mode)
+        if diff == '':
+            diff = None
+        stats = DiffStats(diff)
+
+        if key is not None and self.diff_cache is not None:
+            # Rough estimate of the memory used by the stats
+            size = 64 + sum(64 + len(stat.path) for stat in stats.files)
+            self.diff_cache.set(key, stats, size)
+        return stats
+
+    def _compare_entries(self, path, entry1, entry2, changes):
+        """ Append to `changes` the paths that differ between the two
+        specified tree entries located at the specified path, either of
+        which can be None.
+
+        """
+        if entry1 is not None and entry2 is not None \
+                and entry1.oid == entry2.oid \
+                and entry1.filemode == entry2.filemode:
+            return
+
+        tree1 = tree2 = None
+        if entry1 is not None \
+                and entry1.filemode == pygit2.GIT_FILEMODE_TREE:
+            tree1 = self.repository[entry1.oid]
+            entry1 = None
+        if entry2 is not None \
+                and entry2.filemode == pygit2.GIT_FILEMODE_TREE:
+            tree2 = self.repository[entry2.oid]
+            entry2 = None
+
+        if tree1 is not None or tree2 is not None:
+            self._compare_trees(path + '/', tree1, tree2, changes)
+
+        if entry1 is not None and entry2 is not None:
+            # The type of file is stored in the upper bits of the mode
+            if entry1.filemode & 0o170000 == entry2.filemode & 0o170000:
+                changes.append((path, 'M'))
             else:
-                # First commit in the repo
-                diff = commit.tree.diff_to_tree(swap=True)
+                changes.append((path, 'T'))
+        elif entry1 is not None:
+            changes.append((path, 'D'))
+        elif entry2 is not None:
+            changes.append((path, 'A'))
+
+    def _compare_trees(self, base, tree1, tree2, changes):
+        """ Append to `changes` the paths that differ between the two
+        specified trees, either of which can be None.
+
+        """
+        entries1 = {}
+        if tree1 is not None:
+            entries1 = dict((entry.name, entry) for entry in tree1)
+        entries2 = {}
+        if tree2 is not None:
+            entries2 = dict((entry.name, entry) for entry in tree2)
+
+        for name in set(entries1) | set(entries2):
+            self._compare_entries(
+                base + name, entries1.get(name), entries2.get(name),
+                changes)
+
+    def changed_paths(self, rev_a, rev_b, pathspec=None):
+        """ Returns the paths changed between two revisions.
+
+        Only the trees of the two revisions are compared: the sub-trees
+        that are identical in both are skipped and the content of the files
+        is never read.
+
+        :arg rev_a: hash or reference of the first revision to compare (the
+            oldest one)
+        :type rev_a: str
+        :arg rev_b: hash or reference of the second revision to compare (the
+            most recent one)
+        :type rev_b: str
+        :kwarg pathspec: one or more paths, relative to the root of the
+            repository, of files or directories to restrict the comparison
+            to. Defaults to None, in which case the whole trees are
+            compared.
+        :type pathspec: str or list(str)
+        :return: the sorted list of tuples (path, status) for each file that
+            changed, the status being `A` (added), `D` (deleted), `M`
+            (modified) or `T` (type changed)
+        :rtype: list(tuple(str, str))
+        :raises KeyError: if at least one of the revisions could not be
+            found in the repo
+
+        """
+        tree1 = self.repository.revparse_single('%s^{tree}' % rev_a)
+        tree2 = self.repository.revparse_single('%s^{tree}' % rev_b)
+
+        changes = []
+        if pathspec is None:
+            self._compare_trees('', tree1, tree2, changes)
         else:
-            c_t0 = self.repository.revparse_single(commitid1)
-            c_t1 = self.repository.revparse_single(commitid2)
-            diff = self.repository.diff(c_t0, c_t1)
+            if not isinstance(pathspec, list):
+                pathspec = [pathspec]
+            for path in set(path.strip('/') for path in pathspec):
+                entries = []
+                for tree in [tree1, tree2]:
+                    try:
+                        entries.append(tree[path])
+                    except KeyError:
+                        entries.append(None)
+                self._compare_entries(path, entries[0], entries[1], changes)
+
+        return sorted(set(changes))
+
+    def _path_oid(self, commit, path):
+        """ Return the id of the object found at the specified path in the
+        tree of the specified commit, None if there is none.
 
-        return diff
+        """
+        try:
+            return commit.tree[path].oid
+        except KeyError:
+            return None
+
+    def log(self, rev='HEAD', path=None, since=None, until=None,
+            author=None, offset=0, limit=50, order='time', after=None):
+        """ Return a page of the history of the repository.
+
+        The history is walked lazily, only as far as needed to fill the
+        page. When filtering on a path, the commits are compared using the
+        ids of the trees and files found at this path, the content of the
+        files is never read.
+
+        The commits skipped by `offset` are still walked and filtered, so
+        the cost of a page grows with its offset. To go through a long
+        history, pass the `cursor` of the previous page as `after` instead:
+        the walk then resumes where it stopped.
+
+        :kwarg rev: the hash or reference of the commit from which to start.
+            Defaults to `HEAD`.
+        :type rev: str
+        :kwarg path: the path, relative to the root of the repository, of a
+            file or directory. Only the commits changing it, compared to all
+            their parents, are returned. Defaults to None.
+        :type path: str
+        :kwarg since: only return the commits made after this time, as a
+            unix timestamp. Defaults to None.
+        :type since: int
+        :kwarg until: only return the commits made before this time, as a
+            unix timestamp. Defaults to None.
+        :type until: int
+        :kwarg author: only return the commits whose author name or email
+            contains this string. Defaults to None.
+        :type author: str
+        :kwarg offset: the number of matching commits to skip, they are
+            walked nonetheless. Defaults to 0.
+        :type offset: int
+        :kwarg limit: the maximum number of commits to return, None for no
+            limit. Defaults to 50.
+        :type limit: int
+        :kwarg order: the order of the commits.
+            Can be: `time` (most recent first) or `topo` (parents are
+            never shown before their children, this requires walking the
+            whole history before returning the first commit).
+            Defaults: `time`.
+        :type order: str
+        :kwarg after: the `cursor` of the previous page, the walk starts
+            from these commits instead of `rev`. The other arguments should
+            be the ones used for the previous page, `offset` aside.
+            Defaults to None.
+        :type after: list(str)
+        :return: the list of commits of the page, with the cursor of the
+            next page
+        :rtype: LogPage
+        :raises ValueError: when the order specified is not allowed
+        :raises KeyError: when the revision could not be found in the repo
 
-    def list_branches(self, status='all'):
-        """ Return the list of branches of the repo.
+        """
+        orders = ['time', 'topo']
+        if order not in orders:
+            raise ValueError('order is not in %s' % orders)
+
+        sort = pygit2.GIT_SORT_TIME
+        if order == 'topo':
+            sort |= pygit2.GIT_SORT_TOPOLOGICAL
+
+        if path is not None:
+            path = path.strip('/')
+
+        if after is not None:
+            # Resume the walk where the previous page stopped
+            walker = self.repository.walk(None, sort)
+            for commitid in after:
+                walker.push(self._commit_oid(commitid))
+        else:
+            walker = self.repository.walk(self._commit_oid(rev), sort)
+
+        commits = LogPage()
+        skipped = 0
+        # The commits to walk next: the parents of the commits walked which
+        # were not walked themselves
+        walked = set()
+        pending = set()
+        # Like git, stop walking after a few commits older than `since` in a
+        # row, to allow for some clock skew
+        too_old = 0
+        for commit in walker:
+            walked.add(commit.oid)
+            pending.discard(commit.oid)
+            pending.update(
+                parent for parent in commit.parent_ids
+                if parent not in walked)
+
+            if until is not None and commit.commit_time > until:
+                continue
+            if since is not None and commit.commit_time < since:
+                too_old += 1
+                if order == 'time' and too_old > 5:
+                    break
+                continue
+            too_old = 0
+
+            if author is not None and author not in commit.author.name \
+                    and author not in commit.author.email:
+                continue
+
+            if path is not None:
+                oid = self._path_oid(commit, path)
+                if commit.parents:
+                    if any(oid == self._path_oid(parent, path)
+                           for parent in commit.parents):
+                        continue
+                elif oid is None:
+                    continue
+
+            if skipped < offset:
+                skipped += 1
+                continue
+
+            subject = commit.message.split('\n', 1)[0]
+            commits.append(CommitRecord(
+                commit.oid.hex, subject, commit.author.name,
+                commit.author.email, commit.commit_time,
+                [parent.hex for parent in commit.parent_ids]))
+            if limit is not None and len(commits) >= limit:
+                if pending:
+                    commits.cursor = sorted(oid.hex for oid in pending)
+                break
+
+        return commits
+
+    def _commit_oid(self, commitid):
+        """ Return the id of the commit corresponding to the specified hash
+        or reference.
 
-        :kwarg status: flag used to specify if it should return all the
+        """
+        return self.repository.revparse_single('%s^{commit}' % commitid).oid
+
+    def _graph_positions(self, oids):
+        """ Return the positions of the specified commits in the commit
+        graph, adding them to it if needed.
+
+        """
+        graph = self.commit_graph
+        if any(oid not in graph for oid in oids):
+            # All of them, as the index may be read again from its file
+            graph.add(self.repository, oids)
+        return [graph.position(oid) for oid in oids]
+
+    def is_ancestor(self, commitid, other):
+        """ Return whether a commit is an ancestor of another one, that is
+        whether it can be reached from it.
+
+        A commit is considered to be an ancestor of itself.
+
+        :arg commitid: the hash or reference of the potential ancestor
+        :type commitid: str
+        :arg other: the hash or reference of the potential descendant
+        :type other: str
+        :return: whether `commitid` is an ancestor of `other`
+        :rtype: bool
+        :raises KeyError: if at least one of the commits could not be found
+            in the repo
+
+        """
+        ancestor = self._commit_oid(commitid)
+        descendant = self._commit_oid(other)
+
+        if self.commit_graph is None:
+            return ancestor == descendant \
+                or self.repository.merge_base(
+                    ancestor, descendant) == ancestor
+
+        ancestor, descendant = self._graph_positions([ancestor, descendant])
+        return self.commit_graph.is_ancestor(ancestor, descendant)
+
+    def merge_base(self, commitid1, commitid2):
+        """ Return the best common ancestor of two commits.
+
+        :arg commitid1: the hash or reference of the first commit
+        :type commitid1: str
+        :arg commitid2: the hash or reference of the second commit
+        :type commitid2: str
+        :return: a `pygit2.Oid` object corresponding to the merge base, or
+            None if the two commits have no common history
+        :rtype: pygit2.Oid
+        :raises KeyError: if at least one of the commits could not be found
+            in the repo
+
+        """
+        one = self._commit_oid(commitid1)
+        two = self._commit_oid(commitid2)
+
+        if self.commit_graph is None:
+            return self.repository.merge_base(one, two)
+
+        one, two = self._graph_positions([one, two])
+        bases = self.commit_graph.merge_bases(one, two)
+        if not bases:
+            return None
+        return pygit2.Oid(raw=self.commit_graph.raw_oid(bases[0]))
+
+    def _branch_refs(self, snapshot, status='all'):
+        """ Return the references of the branches of the repo found in the
+        specified snapshot of its references.
+
+        """
+        statuses = ['remote', 'local', 'all']
+        if status not in statuses:
+            raise ValueError('status is not in %s' % statuses)
+
+        prefixes = []
+        if status in ['local', 'all']:
+            prefixes.append('refs/heads/')
+        if status in ['remote', 'all']:
+            prefixes.append('refs/remotes/')
+
+        return [
+            ref
+            for prefix in prefixes
+            for ref in snapshot.names(prefix)
+            if not ref.endswith('/HEAD')
+        ]
+
+    def branches_containing(self, commitid, status='local'):
+        """ Return the list of branches containing the specified commit.
+
+        :arg commitid: the hash or reference of the commit to search for
+        :type commitid: str
+        :kwarg status: flag used to specify if it should search all the
             branches, only the local or the remote ones.
-            Can be: `all`, `local`, `remote`. Detaults: `all`.
+            Can be: `all`, `local`, `remote`. Detaults: `local`.
         :type status: str
-        :return: the list of branches corresponding to the status specified
+        :return: the names of the branches whose history contains the
+            commit, the remote ones being named <remote>/<branchname>
         :rtype: list(str)
         :raises ValueError: when the status specified in not allowed
+        :raises KeyError: if the commit could not be found in the repo
 
         """
-        statuses = ['remote', 'local', 'all']
-        if status not in statuses:
-            raise ValueError('status is not in %s' % statuses)
+        oid = self._commit_oid(commitid)
+
+        snapshot = self.ref_snapshot()
+        tips = []
+        for ref in self._branch_refs(snapshot, status):
+            name = ref.replace('refs/heads/', '', 1)
+            name = name.replace('refs/remotes/', '', 1)
+            tips.append((name, pygit2.Oid(hex=snapshot.resolve(ref))))
+
+        branches = []
+        if self.commit_graph is None:
+            for name, tip in tips:
+                if tip == oid or self.repository.merge_base(oid, tip) == oid:
+                    branches.append(name)
+            return sorted(branches)
+
+        positions = self._graph_positions([oid] + [tip for _, tip in tips])
+        graph = self.commit_graph
+        for (name, _), position in zip(tips, positions[1:]):
+            if graph.is_ancestor(positions[0], position):
+                branches.append(name)
+        return sorted(branches)
+
+    def branch_divergence(self, base=None):
+        """ Return how many commits each local branch is ahead and behind
+        its upstream branch, or the specified base.
+
+        With the commit graph, the counts of all the branches are computed
+        in a single walk of the history. The counts are cached by the ids of
+        the commits compared.
+
+        :kwarg base: the hash or reference of the commit to compare every
+            branch to. Defaults to None, in which case each branch is
+            compared to its upstream branch.
+        :type base: str
+        :return: a dictionary of the name of each local branch and a tuple
+            (ahead, behind) of the number of commits it has that the base
+            has not and conversely, or None if it has no upstream branch
+        :rtype: dict
+        :raises KeyError: if the base could not be found in the repo
+
+        """
+        base_oid = None
+        if base is not None:
+            base_oid = self._commit_oid(base)
+
+        snapshot = self.ref_snapshot()
+        divergence = {}
+        pairs = {}
+        for ref in self._branch_refs(snapshot, 'local'):
+            name = ref.replace('refs/heads/', '', 1)
+            tip = pygit2.Oid(hex=snapshot.resolve(ref))
+            other = base_oid
+            if other is None:
+                upstream = self._upstream_ref(name)
+                if upstream is not None:
+                    upstream = snapshot.resolve(upstream)
+                if upstream is None:
+                    divergence[name] = None
+                    continue
+                other = pygit2.Oid(hex=upstream)
+
+            key = (tip.hex, other.hex)
+            counts = self._divergence_cache.get(key)
+            if counts is None:
+                pairs[name] = (tip, other)
+            else:
+                divergence[name] = counts
+
+        if not pairs:
+            return divergence
 
-        if status == 'remote':
-            branches = self.repository.listall_branches(
-                pygit2.GIT_BRANCH_REMOTE)
-        elif status == 'local':
-            branches = self.repository.listall_branches(
-                pygit2.GIT_BRANCH_LOCAL)
+        names = sorted(pairs)
+        if self.commit_graph is None:
+            counts = [
+                self.repository.ahead_behind(*pairs[name]) for name in names]
+        else:
+            oids = []
+            for name in names:
+                oids.extend(pairs[name])
+            positions = self._graph_positions(oids)
+            counts = self.commit_graph.ahead_behind(
+                list(zip(positions[::2], positions[1::2])))
+
+        for name, count in zip(names, counts):
+            tip, other = pairs[name]
+            divergence[name] = tuple(count)
+            self._divergence_cache.set((tip.hex, other.hex), tuple(count))
+
+        return divergence
+
+    def _upstream_ref(self, branch_name):
+        """ Return the full name of the reference of the upstream branch of
+        a local branch, read from the configuration of the repo, or None if
+        it has none.
+
+        """
+        values = self.get_config_many([
+            'branch.%s.remote' % branch_name,
+            'branch.%s.merge' % branch_name,
+        ])
+        remote = values.get('branch.%s.remote' % branch_name)
+        merge = values.get('branch.%s.merge' % branch_name)
+        if not remote or not merge:
+            return None
+        if remote == '.':
+            return merge
+        return 'refs/remotes/%s/%s' % (
+            remote, merge.replace('refs/heads/', '', 1))
+
+    def list_branches(self, status='all', with_tips=False, sort=None,
+                      limit=None, offset=0):
+        """ Return the list of branches of the repo.
+
+        The references of the branches are read once, the commits at their
+        tips are only loaded when needed to sort the branches or to return
+        the branches of the page requested.
+
+        :kwarg status: flag used to specify if it should return all the
+            branches, only the local or the remote ones.
+            Can be: `all`, `local`, `remote`. Detaults: `all`.
+        :type status: str
+        :kwarg with_tips: whether to return the information about the commit
+            at the tip of each branch instead of only its name.
+            Defaults to False.
+        :type with_tips: bool
+        :kwarg sort: the order of the branches.
+            Can be: `name` or `committerdate` (most recently committed
+            first). Defaults to None, in which case the branches are
+            returned in the order of their references.
+        :type sort: str
+        :kwarg offset: the number of branches to skip. Defaults to 0.
+        :type offset: int
+        :kwarg limit: the maximum number of branches to return, None for no
+            limit. Defaults to None.
+        :type limit: int
+        :return: the list of branches corresponding to the status specified,
+            as their names or as `BranchRecord` if `with_tips` is True
+        :rtype: list(str) or list(BranchRecord)
+        :raises ValueError: when the status or the sort specified is not
+            allowed
+
+        """
+        sorts = ['name', 'committerdate']
+        if sort is not None and sort not in sorts:
+            raise ValueError('sort is not in %s' % sorts)
+
+        snapshot = self.ref_snapshot()
+        branches = []
+        for ref in self._branch_refs(snapshot, status):
+            if ref.startswith('refs/heads/'):
+                name = ref.replace('refs/heads/', '', 1)
+            else:
+                name = ref.replace('refs/remotes/', '', 1)
+            branches.append((name, ref))
+
+        commits = {}
+        if sort == 'name':
+            branches.sort()
+        elif sort == 'committerdate':
+            for name, ref in branches:
+                commits[ref] = self.repository[snapshot.resolve(ref)]
+            branches.sort(
+                key=lambda branch: (-commits[branch[1]].commit_time, branch))
+
+        if limit is None:
+            branches = branches[offset:]
         else:
-            branches = self.repository.listall_branches(
-                pygit2.GIT_BRANCH_REMOTE | pygit2.GIT_BRANCH_LOCAL)
+            branches = branches[offset:offset + limit]
 
-        return branches
+        if not with_tips:
+            return [name for name, ref in branches]
 
-    def list_tags(self):
+        records = []
+        for name, ref in branches:
+            commit = commits.get(ref)
+            if commit is None:
+                commit = self.repository[snapshot.resolve(ref)]
+            upstream = None
+            if ref.startswith('refs/heads/'):
+                upstream = self._upstream_ref(name)
+                if upstream is not None:
+                    upstream = upstream.replace('refs/remotes/', '', 1)
+            records.append(BranchRecord(
+                name, commit.oid.hex, commit.commit_time, commit.author.name,
+                commit.author.email, upstream))
+        return records
+
+    def list_tags(self, peeled=False):
         """ Return the list of tags present in the repository.
 
+        The tags are read from the snapshot of the references of the repo.
+
+        :kwarg peeled: whether to also return the object each tag points to
+            once peeled, that is the commit tagged for annotated tags.
+            Peeled targets present in the packed-refs file are used without
+            loading the tag objects. Defaults to False.
+        :type peeled: bool
+        :return: the sorted list of the names of the tags or, if `peeled` is
+            True, of the tuples (name, hash of the object tagged)
+        :rtype: list(str) or list(tuple(str, str))
+
         """
-        tags = [
-            ref.replace('refs/tags/', '')
-            for ref in self.repository.listall_references()
-            if ref.startswith('refs/tags')
-        ]
-        return tags
+        snapshot = self.ref_snapshot()
+        refs = snapshot.names('refs/tags/')
+        tags = [ref.replace('refs/tags/', '', 1) for ref in refs]
+        if not peeled:
+            return tags
+
+        targets = []
+        for ref in refs:
+            if ref not in snapshot.peeled:
+                obj = self.repository[snapshot.resolve(ref)]
+                while obj.type == pygit2.GIT_OBJ_TAG:
+                    obj = self.repository[obj.target]
+                snapshot.peeled[ref] = obj.oid.hex
+            targets.append(snapshot.peeled[ref])
+        return list(zip(tags, targets))
 
     def tag(self, tag, commitid=None, message=None):
         """ Add a tag to the repository.
@@ -321,10 +2492,7 @@ class GitRepo(object):
 
         """
 
-        author = pygit2.Signature(
-            self.get_config('user.name'),
-            self.get_config('user.email'),
-        )
+        author = self._signature()
 
         # Create the tag
         if commitid is None:
@@ -333,6 +2501,169 @@ class GitRepo(object):
         return self.repository.create_tag(
             tag, commitid, pygit2.GIT_OBJ_COMMIT, author, message or '')
 
+    def _write_packed_refs(self, names, build_refs):
+        """ Add the specified references to the packed-refs file, replacing
+        it at once.
+
+        :arg names: the full names of the references to add
+        :type names: list(str)
+        :arg build_refs: the function returning the list of tuples (name,
+            hash of the target, hash of the peeled target or None) of the
+            references to add. It is only called once the lock on the
+            packed-refs file is held and the references are known not to
+            exist, so the objects it writes are never left unreferenced.
+        :type build_refs: callable
+        :raises pygit2_utils.exceptions.ReferenceExistsError: when one of
+            the references already exists
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            packed-refs file is being written by someone else
+
+        """
+        path = os.path.join(
+            RefSnapshot.common_dir(self.repository.path), 'packed-refs')
+        lock_path = path + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                raise pygit2_utils.exceptions.ReferenceChangedError()
+            raise
+
+        renamed = False
+        try:
+            # Checked with the lock held, so that no one packs the
+            # references in the mean time
+            snapshot = self.ref_snapshot(refresh=True)
+            for name in names:
+                if name in snapshot.refs:
+                    raise pygit2_utils.exceptions.ReferenceExistsError()
+            refs = build_refs()
+
+            try:
+                with open(path) as stream:
+                    lines = stream.read().splitlines()
+            except (IOError, OSError):
+                lines = ['# pack-refs with: peeled fully-peeled sorted ']
+
+            header = []
+            if lines and lines[0].startswith('#'):
+                header.append(lines.pop(0))
+
+            # Keep each reference with the peeled line following it
+            entries = []
+            for line in lines:
+                if line.startswith('^') and entries:
+                    entries[-1] = (entries[-1][0], entries[-1][1] + [line])
+                elif line:
+                    entries.append((line.split(' ', 1)[1], [line]))
+            for name, target, peeled in refs:
+                entry = ['%s %s' % (target, name)]
+                if peeled is not None:
+                    entry.append('^%s' % peeled)
+                entries.append((name, entry))
+            entries.sort(key=lambda entry: entry[0])
+
+            with os.fdopen(fd, 'w') as stream:
+                fd = None
+                for line in header:
+                    stream.write(line + '\n')
+                for _, entry in entries:
+                    for line in entry:
+                        stream.write(line + '\n')
+            os.rename(lock_path, path)
+            renamed = True
+        finally:
+            if fd is not None:
+                os.close(fd)
+            # Once renamed, the lock file may already be someone else's
+            if not renamed:
+                os.unlink(lock_path)
+
+    def tag_many(self, tags, lightweight=False):
+        """ Add several tags to the repository at once.
+
+        The signature is resolved once for all the tags and the tags are
+        written together to the packed-refs file, no loose reference is
+        created.
+
+        :arg tags: the list of tuples (tag, commitid, message) of the tags
+            to apply, the hash of the commit to tag and the message to
+            associate to the tag. The message is ignored for lightweight
+            tags.
+        :type tags: list(tuple(str, str, str))
+        :kwarg lightweight: whether to create lightweight tags, pointing
+            directly to the commits, instead of annotated tag objects.
+            Defaults to False.
+        :type lightweight: bool
+        :return: the list of the `pygit2.Oid` of the tag objects created or,
+            for lightweight tags, of the commits tagged
+        :rtype: list(pygit2.Oid)
+        :raises ValueError: when the name of a tag is not valid or is given
+            more than once
+        :raises KeyError: when a commit could not be found in the repo
+        :raises pygit2_utils.exceptions.ReferenceExistsError: when one of
+            the tags already exists, in which case no tag is added
+
+        """
+        names = set()
+        for tag, _, _ in tags:
+            if tag in names or not pygit2.reference_is_valid_name(
+                    'refs/tags/%s' % tag):
+                raise ValueError('Invalid tag name: %s' % tag)
+            names.add(tag)
+
+        if not lightweight:
+            author = self._signature()
+            offset = '%s%02d%02d' % (
+                '-' if author.offset < 0 else '+',
+                abs(author.offset) // 60, abs(author.offset) % 60)
+            tagger = 'tagger %s <%s> %d %s\n' % (
+                author.name, author.email, author.time, offset)
+
+        commits = [
+            self._commit_oid(commitid) for _, commitid, _ in tags]
+
+        oids = []
+
+        def _build_refs():
+            # The tag objects are only written once the tags are known not
+            # to exist
+            refs = []
+            for (tag, _, message), commit in zip(tags, commits):
+                if lightweight:
+                    refs.append(('refs/tags/%s' % tag, commit.hex, None))
+                    oids.append(commit)
+                    continue
+
+                data = (
+                    'object %s\ntype commit\ntag %s\n' % (commit.hex, tag)
+                    + tagger + '\n' + (message or ''))
+                oid = self.repository.write(
+                    pygit2.GIT_OBJ_TAG, data.encode('utf-8'))
+                refs.append(('refs/tags/%s' % tag, oid.hex, commit.hex))
+                oids.append(oid)
+            return refs
+
+        if tags:
+            self._write_packed_refs(
+                ['refs/tags/%s' % tag for tag, _, _ in tags], _build_refs)
+        return oids
+
+    def _branch_ref(self, snapshot, branch_name):
+        """ Return the full name of the reference of the specified branch
+        in the specified snapshot of the references, looking for a local
+        branch first and then for a remote one.
+
+        :raises pygit2_utils.exceptions.NoSuchBranchError: when the branch
+            cannot be found in the repository
+
+        """
+        for prefix in ['refs/heads/', 'refs/remotes/']:
+            ref = prefix + branch_name
+            if snapshot.resolve(ref) is not None:
+                return ref
+        raise pygit2_utils.exceptions.NoSuchBranchError()
+
     def checkout(self, branch_name):
         """ Checkout the specified branch
 
@@ -344,18 +2675,8 @@ class GitRepo(object):
             cannot be found in the repository
 
         """
-        # Check if the branch exists locally
-        branch = self.repository.lookup_branch(
-            branch_name, pygit2.GIT_BRANCH_LOCAL)
-        # If we do not have a local branch, check if it is a remote one
-        if branch is None:
-            branch = self.repository.lookup_branch(
-                branch_name, pygit2.GIT_BRANCH_REMOTE)
-        # If it is not a local nor a remote, raise exception
-        if branch is None:
-            raise pygit2_utils.exceptions.NoSuchBranchError()
-
-        ref = self.repository.lookup_reference(branch.name)
+        ref = self.repository.lookup_reference(
+            self._branch_ref(self.ref_snapshot(), branch_name))
 
         self.repository.checkout(ref)
 
@@ -373,19 +2694,9 @@ class GitRepo(object):
             cannot be found in the repository
 
         """
-        # Check if the branch exists locally
-        branch = self.repository.lookup_branch(
-            branch_name, pygit2.GIT_BRANCH_LOCAL)
-        # If we do not have a local branch, check if it is a remote one
-        if branch is None:
-            branch = self.repository.lookup_branch(
-                branch_name, pygit2.GIT_BRANCH_REMOTE)
-        # If it is not a local nor a remote, raise exception
-        if branch is None:
-            raise pygit2_utils.exceptions.NoSuchBranchError()
-
-        ref = self.repository.lookup_reference(branch.name)
-        return ref.get_object()
+        snapshot = self.ref_snapshot()
+        ref = self._branch_ref(snapshot, branch_name)
+        return self.repository[snapshot.resolve(ref)]
 
     def add_remote(self, remote_name, remote_url):
         """ Add a remote to the git repository using the provided name and
@@ -404,7 +2715,171 @@ class GitRepo(object):
 
         return remote
 
-    def get_patch(self, commit_ids):
+    def _commit_patch(self, commit, merge_diff_mode=None):
+        """ Return the diff of the specified commit as text, using the diff
+        cache if there is one.
+
+        """
+        key = self._diff_key(
+            'patch', commit.oid.hex, merge_diff_mode=merge_diff_mode)
+        if key is not None and self.diff_cache is not None:
+            patch = self.diff_cache.get(key)
+            if patch is not None:
+                return patch
+
+        diff = self.diff(commit.oid.hex, merge_diff_mode=merge_diff_mode)
+        patch = ''
+        if diff != '':
+            patch = diff.patch or ''
+
+        if key is not None and self.diff_cache is not None:
+            self.diff_cache.set(key, patch, len(patch))
+        return patch
+
+    def _format_patch(self, commit, patch, cnt, total):
+        """ Return the patch of a commit formated as would
+        `git-format patch`.
+
+        :arg commit: the commit to format
+        :type commit: pygit2.Commit
+        :arg patch: the diff of the commit as text
+        :type patch: str
+        :arg cnt: the position of the commit in the series, starting at 0
+        :type cnt: int
+        :arg total: the number of commits in the series
+        :type total: int
+
+        """
+        # Only imported when needed to keep importing pygit2_utils cheap
+        import datetime
+
+        subject = message = ''
+        if '\n' in commit.message:
+            subject, message = commit.message.split('\n', 1)
+        else:
+            subject = commit.message
+
+        if total > 1:
+            subject = '[PATCH %s/%s] %s' % (cnt + 1, total, subject)
+
+        var = {
+            'commit': commit.oid.hex,
+            'author_name': commit.author.name,
+            'author_email': commit.author.email,
+            'date': datetime.datetime.utcfromtimestamp(
+                commit.commit_time).strftime('%b %d %Y %H:%M:%S +0000'),
+            'subject': subject,
+            'msg': message,
+            'patch': patch,
+        }
+
+        return """From %(commit)s Mon Sep 17 00:00:00 2001
+From: %(author_name)s <%(author_email)s>
+Date: %(date)s
+Subject: %(subject)s
+
+%(msg)s
+---
+
+%(patch)s
+""" % (var)
+
+    def iter_patches(self, commit_ids, workers=None, executor=None,
+                     merge_diff_mode=None):
+        """ Yield the patch of one or more commits formated as would
+        `git-format patch`, one commit at a time.
+
+        The diffs of the commits can be computed in parallel, either on a
+        pool of `workers` threads or using the specified executor, the
+        patches are still yielded in the order of the commits.
+
+        :arg commit_ids: one or more commit hashes to return in a
+            `git format-path` format thus compatible with `git am`.
+        :type commit_ids: str or list(str)
+        :kwarg workers: the number of threads to use to compute the diffs.
+            Defaults to None, in which case they are computed one after the
+            other unless an executor is specified.
+        :type workers: int
+        :kwarg executor: the executor to use to compute the diffs.
+            Defaults to None.
+        :type executor: concurrent.futures.Executor
+        :kwarg merge_diff_mode: how to compute the diff of the merge commits,
+            see `diff`. Defaults to None, in which case their diff is empty.
+        :type merge_diff_mode: str
+        :return: a generator of the diff of each commit in a
+            `git format-patch` format
+        :rtype: generator
+
+        """
+        if not isinstance(commit_ids, list):
+            commit_ids = [commit_ids]
+
+        total = len(commit_ids)
+
+        def _patch(cnt, commitid):
+            commit = self.repository.revparse_single(commitid)
+            patch = self._commit_patch(commit, merge_diff_mode)
+            return self._format_patch(commit, patch, cnt, total)
+
+        if workers is None and executor is None:
+            for cnt, commitid in enumerate(commit_ids):
+                yield _patch(cnt, commitid)
+            return
+
+        pool = None
+        if executor is None:
+            # Only imported when needed to keep importing pygit2_utils cheap
+            import multiprocessing.pool
+            pool = multiprocessing.pool.ThreadPool(workers)
+
+        # Only keep a limited number of patches ahead of the one yielded so
+        # the memory used remains bounded
+        window = collections.deque()
+        size = 2 * (workers or 4)
+        try:
+            for cnt, commitid in enumerate(commit_ids):
+                if pool is None:
+                    window.append(
+                        executor.submit(_patch, cnt, commitid).result)
+                else:
+                    window.append(
+                        pool.apply_async(_patch, (cnt, commitid)).get)
+                if len(window) >= size:
+                    yield window.popleft()()
+            while window:
+                yield window.popleft()()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def write_patches(self, commit_ids, fileobj, workers=None,
+                      executor=None, merge_diff_mode=None):
+        """ Write the patch of one or more commits formated as would
+        `git-format patch` to the specified file object.
+
+        :arg commit_ids: one or more commit hashes to return in a
+            `git format-path` format thus compatible with `git am`.
+        :type commit_ids: str or list(str)
+        :arg fileobj: the file object to write the patches into
+        :type fileobj: file
+        :kwarg workers: the number of threads to use to compute the diffs,
+            see `iter_patches`. Defaults to None.
+        :type workers: int
+        :kwarg executor: the executor to use to compute the diffs, see
+            `iter_patches`. Defaults to None.
+        :type executor: concurrent.futures.Executor
+        :kwarg merge_diff_mode: how to compute the diff of the merge commits,
+            see `diff`. Defaults to None.
+        :type merge_diff_mode: str
+
+        """
+        for patch in self.iter_patches(
+                commit_ids, workers=workers, executor=executor,
+                merge_diff_mode=merge_diff_mode):
+            fileobj.write(patch)
+
+    def get_patch(self, commit_ids, workers=None, executor=None,
+                  merge_diff_mode=None):
         """ Return the patch formated as would `git-format patch` for one or
         more commits.
 
@@ -415,51 +2890,392 @@ class GitRepo(object):
         :arg commit_ids: one or more commit hashes to return in a
             `git format-path` format thus compatible with `git am`.
         :type commit_ids: str or list(str)
+        :kwarg workers: the number of threads to use to compute the diffs,
+            see `iter_patches`. Defaults to None.
+        :type workers: int
+        :kwarg executor: the executor to use to compute the diffs, see
+            `iter_patches`. Defaults to None.
+        :type executor: concurrent.futures.Executor
+        :kwarg merge_diff_mode: how to compute the diff of the merge commits,
+            see `diff`. Defaults to None.
+        :type merge_diff_mode: str
         :return: the diff of the commits in a `git format-patch` format
         :rtype: str
 
         """
+        return ''.join(self.iter_patches(
+            commit_ids, workers=workers, executor=executor,
+            merge_diff_mode=merge_diff_mode))
+
+    def _move_ref(self, ref, old_target, new_target):
+        """ Move the specified reference to a new target, provided it still
+        points to the old one.
+
+        :arg ref: the full name of the reference to move
+        :type ref: str
+        :arg old_target: the target the reference is expected to point to,
+            None if it is expected not to exist
+        :type old_target: pygit2.Oid
+        :arg new_target: the new target of the reference
+        :type new_target: pygit2.Oid
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            reference was moved, created or removed in the mean time
 
-        if not isinstance(commit_ids, list):
-            commit_ids = [commit_ids]
+        """
+        if old_target is None:
+            # Fails if the reference was created in the mean time
+            try:
+                self.repository.create_reference(ref, new_target)
+            except (ValueError, pygit2.GitError):
+                raise pygit2_utils.exceptions.ReferenceChangedError()
+            return
 
-        patch = ""
-        for cnt, commitid in enumerate(commit_ids):
-            commit = self.repository.revparse_single(commitid)
-            diff = self.diff(commit.oid.hex)
+        try:
+            reference = self.repository.lookup_reference(ref).resolve()
+        except KeyError:
+            raise pygit2_utils.exceptions.ReferenceChangedError()
+        if reference.target != old_target:
+            raise pygit2_utils.exceptions.ReferenceChangedError()
+        reference.set_target(new_target)
+
+    def _target_ref(self, target_ref):
+        """ Return the full name of the reference corresponding to the
+        specified branch name or reference, and its current target.
+
+        """
+        snapshot = self.ref_snapshot()
+        if not target_ref.startswith('refs/'):
+            target_ref = 'refs/heads/%s' % target_ref
+        target = snapshot.resolve(target_ref)
+        if target is not None:
+            target = pygit2.Oid(hex=target)
+        return target_ref, target
+
+    def merge_commits(self, ours, theirs, target_ref=None, message=None,
+                      username=None, useremail=None):
+        """ Merge a commit into another one without using the index nor the
+        working tree of the repo.
+
+        The trees of the commits are merged in memory and the merge commit
+        is written directly to the object database, this works in bare
+        repositories as well.
+
+        :arg ours: the hash or reference of the commit into which to merge
+        :type ours: str
+        :arg theirs: the hash or reference of the commit to merge
+        :type theirs: str
+        :kwarg target_ref: the name of the branch, or the reference, to move
+            to the result of the merge. It is only moved if it still points
+            to `ours`. Defaults to None, in which case no reference is
+            updated.
+        :type target_ref: str
+        :kwarg message: the message to use in the merge commit (in case
+            fastforward is not an option)
+        :type message: str
+        :kwarg username: the username to use for the merge commit (if there
+            is one)
+        :type username: str
+        :kwarg useremail: the email address to use for the merge commit (if
+            there is one)
+        :type useremail: str
+        :return: a `pygit2.Oid` object corresponding to the merge commit, or
+            to `theirs` if it could be fast-forwarded
+        :rtype: pygit2.Oid
+        :raises KeyError: if at least one of the commits could not be found
+            in the repo
+        :raises pygit2_utils.exceptions.NothingToMergeError: when there is
+            nothing to merge because `theirs` is already in `ours`
+        :raises pygit2_utils.exceptions.MergeConflictsError: when the merge
+            cannot be done because of a conflict
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            target reference does not point to `ours`
+
+        """
+        ours_oid = self._commit_oid(ours)
+        theirs_oid = self._commit_oid(theirs)
+
+        if target_ref is not None:
+            target_ref, target = self._target_ref(target_ref)
+            if target != ours_oid:
+                raise pygit2_utils.exceptions.ReferenceChangedError()
+
+        base = self.repository.merge_base(ours_oid, theirs_oid)
+        if base == theirs_oid:
+            raise pygit2_utils.exceptions.NothingToMergeError()
+
+        if base == ours_oid:
+            sha = theirs_oid
+        else:
+            index = self.repository.merge_commits(ours_oid, theirs_oid)
+            if index.conflicts is not None:
+                raise pygit2_utils.exceptions.MergeConflictsError()
+            tree = index.write_tree(self.repository)
+
+            if message is None:
+                message = 'Merge %s into %s' % (theirs, target_ref or ours)
+            author = self._signature(username, useremail)
+            sha = self.repository.create_commit(
+                None, author, author, message, tree, [ours_oid, theirs_oid])
 
-            subject = message = ''
-            if '\n' in commit.message:
-                subject, message = commit.message.split('\n', 1)
+        if target_ref is not None:
+            self._move_ref(target_ref, ours_oid, sha)
+        return sha
+
+    def _merge_check(self, source, target):
+        """ Return the `MergeCheck` of merging the commit `source` into the
+        commit `target`, specified by their ids.
+
+        """
+        key = (source.hex, target.hex)
+        check = self._merge_cache.get(key)
+        if check is not None:
+            return check
+
+        base = self.repository.merge_base(target, source)
+        if base == source:
+            check = MergeCheck('up-to-date', [])
+        elif base == target:
+            check = MergeCheck('fast-forward', [])
+        else:
+            index = self.repository.merge_commits(target, source)
+            conflicts = []
+            if index.conflicts is not None:
+                # Each conflict holds the entries of the base, ours and
+                # theirs, some of which are None
+                for entries in index.conflicts:
+                    paths = [
+                        entry.path for entry in entries if entry is not None]
+                    conflicts.append(paths[0])
+            if conflicts:
+                check = MergeCheck('conflicted', sorted(conflicts))
             else:
-                subject = commit.message
-
-            if len(commit_ids) > 1:
-                subject = '[PATCH %s/%s] %s' % (
-                    cnt + 1, len(commit_ids), subject)
-
-            var = {
-                'commit': commit.oid.hex,
-                'author_name': commit.author.name,
-                'author_email': commit.author.email,
-                'date': datetime.datetime.utcfromtimestamp(
-                    commit.commit_time).strftime('%b %d %Y %H:%M:%S +0000'),
-                'subject': subject,
-                'msg': message,
-                'patch': diff.patch,
-            }
-
-            patch += """From %(commit)s Mon Sep 17 00:00:00 2001
-From: %(author_name)s <%(author_email)s>
-Date: %(date)s
-Subject: %(subject)s
+                check = MergeCheck('clean', [])
 
-%(msg)s
----
+        self._merge_cache.set(key, check)
+        return check
 
-%(patch)s
-""" % (var)
-        return patch
+    def can_merge(self, source, target):
+        """ Return whether a commit can be merged into another one, without
+        changing the references, the index nor the working tree of the repo.
+
+        The result is cached by the ids of the two commits.
+
+        :arg source: the hash or reference of the commit to merge
+        :type source: str
+        :arg target: the hash or reference of the commit into which to merge
+        :type target: str
+        :return: a `MergeCheck` holding the `status` of the merge and the
+            sorted list of the paths in conflict (`conflicts`). The status
+            can be: `up-to-date` (nothing to merge), `fast-forward`, `clean`
+            (a merge commit is needed) or `conflicted`.
+        :rtype: MergeCheck
+        :raises KeyError: if at least one of the commits could not be found
+            in the repo
+
+        """
+        return self._merge_check(
+            self._commit_oid(source), self._commit_oid(target))
+
+    def can_merge_many(self, sources, target, workers=None, executor=None):
+        """ Return whether each of the specified commits can be merged into
+        another one, see `can_merge`.
+
+        The merges can be checked in parallel, either on a pool of `workers`
+        threads or using the specified executor.
+
+        :arg sources: the hashes or references of the commits to merge
+        :type sources: list(str)
+        :arg target: the hash or reference of the commit into which to merge
+        :type target: str
+        :kwarg workers: the number of threads to use to check the merges.
+            Defaults to None, in which case they are checked one after the
+            other unless an executor is specified.
+        :type workers: int
+        :kwarg executor: the executor to use to check the merges.
+            Defaults to None.
+        :type executor: concurrent.futures.Executor
+        :return: a dictionary of each source specified and its `MergeCheck`
+        :rtype: dict
+        :raises KeyError: if at least one of the commits could not be found
+            in the repo
+
+        """
+        target = self._commit_oid(target)
+        oids = [self._commit_oid(source) for source in sources]
+
+        def _check(oid):
+            return self._merge_check(oid, target)
+
+        if workers is None and executor is None:
+            checks = [_check(oid) for oid in oids]
+        elif executor is not None:
+            checks = list(executor.map(_check, oids))
+        else:
+            # Only imported when needed to keep importing pygit2_utils cheap
+            import multiprocessing.pool
+            pool = multiprocessing.pool.ThreadPool(workers)
+            try:
+                checks = pool.map(_check, oids)
+            finally:
+                pool.terminate()
+
+        return dict(zip(sources, checks))
+
+    def _replay_commit(self, commit, onto, committer):
+        """ Return the id of a copy of the specified commit applied on top
+        of the commit `onto`, or None if it changes nothing there.
+
+        The changes of the commit are applied by merging the trees in
+        memory, its author and message are kept.
+
+        :raises ValueError: when the commit is a merge commit
+        :raises pygit2_utils.exceptions.MergeConflictsError: when the
+            changes of the commit conflict with the commit `onto`
+
+        """
+        if len(commit.parents) > 1:
+            raise ValueError(
+                'Cannot replay the merge commit %s' % commit.oid.hex)
+        if commit.parents:
+            ancestor = commit.parents[0].tree
+        else:
+            ancestor = self.repository[self.repository.TreeBuilder().write()]
+
+        onto_commit = self.repository[onto]
+        index = self.repository.merge_trees(
+            ancestor, onto_commit.tree, commit.tree)
+        if index.conflicts is not None:
+            raise pygit2_utils.exceptions.MergeConflictsError()
+        tree = index.write_tree(self.repository)
+        if tree == onto_commit.tree.oid:
+            return None
+
+        return self.repository.create_commit(
+            None, commit.author, committer, commit.message, tree, [onto])
+
+    def cherry_pick(self, commitid, onto, target_ref=None, username=None,
+                    useremail=None):
+        """ Apply the changes of a commit on top of another commit, without
+        using the index nor the working tree of the repo.
+
+        The new commit keeps the author and the message of the original one.
+
+        :arg commitid: the hash or reference of the commit to apply
+        :type commitid: str
+        :arg onto: the hash or reference of the commit on top of which to
+            apply it
+        :type onto: str
+        :kwarg target_ref: the name of the branch, or the reference, to move
+            to the new commit. It is only moved if it still points to
+            `onto`. Defaults to None, in which case no reference is updated.
+        :type target_ref: str
+        :kwarg username: the username to use as committer
+        :type username: str
+        :kwarg useremail: the email address to use as committer
+        :type useremail: str
+        :return: a `pygit2.Oid` object corresponding to the new commit
+        :rtype: pygit2.Oid
+        :raises KeyError: if at least one of the commits could not be found
+            in the repo
+        :raises ValueError: when the commit to apply is a merge commit
+        :raises pygit2_utils.exceptions.NothingToMergeError: when the
+            changes of the commit are already present in `onto`
+        :raises pygit2_utils.exceptions.MergeConflictsError: when the
+            changes of the commit conflict with `onto`
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            target reference does not point to `onto`
+
+        """
+        commit = self.repository[self._commit_oid(commitid)]
+        onto_oid = self._commit_oid(onto)
+
+        if target_ref is not None:
+            target_ref, target = self._target_ref(target_ref)
+            if target != onto_oid:
+                raise pygit2_utils.exceptions.ReferenceChangedError()
+
+        committer = self._signature(username, useremail)
+        sha = self._replay_commit(commit, onto_oid, committer)
+        if sha is None:
+            raise pygit2_utils.exceptions.NothingToMergeError()
+
+        if target_ref is not None:
+            self._move_ref(target_ref, onto_oid, sha)
+        return sha
+
+    def rebase(self, branch, onto, stop_on_conflict=True, username=None,
+               useremail=None):
+        """ Replay the commits of a branch that are not in another commit on
+        top of it, without using the index nor the working tree of the repo.
+
+        The commits are replayed by merging trees in memory, in topological
+        order, keeping their author and message. Merge commits and commits
+        whose changes are already present are dropped, as git does. The
+        branch is moved once, when all the commits have been replayed.
+
+        :arg branch: the name of the branch, or the reference, to rebase
+        :type branch: str
+        :arg onto: the hash or reference of the commit on top of which to
+            replay the commits
+        :type onto: str
+        :kwarg stop_on_conflict: whether to stop and leave the branch as it
+            is when a commit cannot be replayed because of a conflict, or to
+            drop the conflicting commits. Defaults to True.
+        :type stop_on_conflict: bool
+        :kwarg username: the username to use as committer
+        :type username: str
+        :kwarg useremail: the email address to use as committer
+        :type useremail: str
+        :return: a `RebaseResult` holding the new `tip` of the branch, the
+            list of tuples (original commit, new commit) of the `commits`
+            replayed and the list of the commits `skipped`, as `pygit2.Oid`
+        :rtype: RebaseResult
+        :raises KeyError: if the commit `onto` could not be found in the
+            repo
+        :raises pygit2_utils.exceptions.NoSuchBranchError: when the branch
+            cannot be found in the repository
+        :raises pygit2_utils.exceptions.MergeConflictsError: when a commit
+            cannot be replayed because of a conflict and `stop_on_conflict`
+            is True
+        :raises pygit2_utils.exceptions.ReferenceChangedError: when the
+            branch was moved while being rebased
+
+        """
+        ref, tip = self._target_ref(branch)
+        if tip is None:
+            raise pygit2_utils.exceptions.NoSuchBranchError()
+        onto_oid = self._commit_oid(onto)
+
+        # The branch already contains `onto`: nothing to do
+        if self.repository.merge_base(tip, onto_oid) == onto_oid:
+            return RebaseResult(tip, [], [])
+
+        walker = self.repository.walk(
+            tip, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+        walker.hide(onto_oid)
+
+        committer = self._signature(username, useremail)
+        new_tip = onto_oid
+        commits = []
+        skipped = []
+        for commit in walker:
+            if len(commit.parents) > 1:
+                skipped.append(commit.oid)
+                continue
+            try:
+                sha = self._replay_commit(commit, new_tip, committer)
+            except pygit2_utils.exceptions.MergeConflictsError:
+                if stop_on_conflict:
+                    raise
+                sha = None
+            if sha is None:
+                skipped.append(commit.oid)
+                continue
+            commits.append((commit.oid, sha))
+            new_tip = sha
+
+        self._move_ref(ref, tip, new_tip)
+        return RebaseResult(new_tip, commits, skipped)
 
     def merge(self, commitid, branch_name='master', message=None,
               username=None, useremail=None):
@@ -506,12 +3322,7 @@ Subject: %(subject)s
 
         parent = self.repository.revparse_single('HEAD').oid.hex
 
-        if username is None:
-            username = self.get_config('user.name')
-        if useremail is None:
-            useremail = self.get_config('user.email')
-
-        author = pygit2.Signature(username, useremail)
+        author = self._signature(username, useremail)
 
         sha = None
         if ((merge is not None and merge.is_uptodate)
@@ -0,0 +1,132 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+This module presents the cache used by pygit2_utils to keep the results
+computed from immutable git objects (diffs, ...) in memory.
+
+"""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """ A thread-safe cache bounded in size, evicting the least recently
+    used entries first.
+
+    Each entry is stored with its (approximate) size in bytes, the cache
+    keeps the sum of these sizes under `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=None):
+        """ Constructor of the LRUCache class.
+
+        :kwarg max_bytes: the maximum size of the entries kept in the cache.
+            Defaults to 64MiB.
+        :type max_bytes: int
+        :kwarg max_entries: the maximum number of entries kept in the cache.
+            Defaults to None, in which case only the size is bounded.
+        :type max_entries: int
+
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getstate__(self):
+        """ Return the state of the object to pickle, without its lock. """
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """ Return the statistics of the cache as a dictionary. """
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def get(self, key, default=None):
+        """ Return the value stored for the specified key.
+
+        :arg key: the key of the entry to return
+        :type key: hashable
+        :kwarg default: the value to return if the key is not in the cache.
+            Defaults to None.
+        :return: the value stored for this key or the default value
+
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            value, size = self._entries.pop(key)
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=1):
+        """ Store the specified value for the specified key, evicting the
+        least recently used entries if needed.
+
+        Values larger than the cache itself are not stored.
+
+        :arg key: the key of the entry to store
+        :type key: hashable
+        :arg value: the value to store
+        :kwarg size: the size of the value, in bytes. Defaults to 1.
+        :type size: int
+
+        """
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes or (
+                    self.max_entries is not None
+                    and len(self._entries) > self.max_entries):
+                self.size -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove all the entries from the cache.
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -61,3 +61,17 @@ class ConfigurationChangeError(PyGitUtilsError):
     configuration and pygit2 changed the format returned.
     """
     message = 'Unknown data format retrieved'
+
+
+class ReferenceChangedError(PyGitUtilsError):
+    """ Exception raised when trying to update a reference which was moved
+    since its value was read.
+    """
+    message = 'This reference was updated in the mean time'
+
+
+class ReferenceExistsError(PyGitUtilsError):
+    """ Exception raised when trying to create a reference which already
+    exists in the repo.
+    """
+    message = 'This reference already exists'
@@ -0,0 +1,356 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+This module presents the commit graph index used by pygit2_utils to answer
+reachability queries (is a commit an ancestor of another, merge-base...)
+without walking the whole history.
+
+For each commit, the index stores its parents and its generation number:
+1 for a root commit, 1 + the highest generation of its parents otherwise.
+A commit can only be an ancestor of commits with a higher generation,
+which allows to stop walking the history early.
+
+The index is kept in a file next to the repository to which records are
+only ever appended: commits are immutable, so it is updated incrementally
+as new commits are reached. Appending is done holding a `<file>.lock` lock
+file, as git does for its own files.
+
+"""
+
+import array
+import errno
+import heapq
+import os
+import struct
+
+
+MAGIC = b'P2UG\x01'
+
+# Flags used when looking for merge bases
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+
+
+class CommitGraph(object):
+    """ An on-disk index of the generation numbers and parents of the
+    commits of a repository.
+    """
+
+    def __init__(self, path):
+        """ Constructor of the CommitGraph class.
+
+        :arg path: the path of the file holding the index, it is created
+            if it does not exist
+        :type path: str
+
+        """
+        self.path = path
+        self._load()
+
+    def __len__(self):
+        return len(self._oids)
+
+    def __contains__(self, oid):
+        return oid.raw in self._index
+
+    def _load(self):
+        """ Load the index from its file, ignoring a truncated record at
+        its end and anything following it. The next records added are
+        written in their place.
+        """
+        self._oids = []
+        self._index = {}
+        self.generations = array.array('I')
+        self._parent_start = array.array('I')
+        self._parents = array.array('I')
+        self._size = 0
+
+        try:
+            with open(self.path, 'rb') as stream:
+                data = stream.read()
+        except (IOError, OSError):
+            return
+
+        if not data.startswith(MAGIC):
+            return
+
+        offset = len(MAGIC)
+        while offset + 25 <= len(data):
+            generation, nparents = struct.unpack_from(
+                '<IB', data, offset + 20)
+            end = offset + 25 + 4 * nparents
+            if end > len(data):
+                break
+            parents = struct.unpack_from('<%dI' % nparents, data, offset + 25)
+            if any(parent >= len(self._oids) for parent in parents):
+                # Not a record written by add, the parents come first
+                break
+            self._append(data[offset:offset + 20], generation, parents)
+            offset = end
+        self._size = offset
+
+    def _append(self, raw, generation, parents):
+        """ Add a commit to the index in memory and return its position.
+        """
+        idx = len(self._oids)
+        self._oids.append(raw)
+        self._index[raw] = idx
+        self.generations.append(generation)
+        self._parent_start.append(len(self._parents))
+        self._parents.extend(parents)
+        return idx
+
+    def parents(self, idx):
+        """ Return the positions of the parents of the commit at the
+        specified position.
+        """
+        start = self._parent_start[idx]
+        if idx + 1 < len(self._parent_start):
+            end = self._parent_start[idx + 1]
+        else:
+            end = len(self._parents)
+        return self._parents[start:end]
+
+    def position(self, oid):
+        """ Return the position of the specified commit in the index.
+
+        :raises KeyError: when the commit is not in the index
+        """
+        return self._index[oid.raw]
+
+    def raw_oid(self, idx):
+        """ Return the raw id of the commit at the specified position. """
+        return self._oids[idx]
+
+    def add(self, repository, oids):
+        """ Add the specified commits and all their ancestors to the index,
+        appending them to its file.
+
+        The index is read again from its file if it changed in the mean
+        time, which can change the positions of the commits: look them up
+        once this is done.
+
+        :arg repository: the repository holding the commits
+        :type repository: pygit2.Repository
+        :arg oids: the ids of the commits to add
+        :type oids: list(pygit2.Oid)
+
+        """
+        lock_path = self.path + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            # Someone else is appending to the file, only index the commits
+            # in memory
+            fd = None
+
+        try:
+            # If someone else appended to the file, start from its content.
+            # Checked with the lock held, so that the positions of the
+            # parents written are the ones of the file.
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size != self._size:
+                self._load()
+
+            records = self._index_commits(repository, oids)
+            if not records:
+                return
+
+            if fd is None:
+                # The records are not in the file, read it again next time
+                self._size = -1
+                return
+
+            # Write after the last complete record read, dropping a record
+            # partially written or the content of a file that is not an
+            # index
+            stream = os.fdopen(
+                os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+b')
+            with stream:
+                stream.seek(self._size)
+                stream.truncate()
+                if self._size == 0:
+                    stream.write(MAGIC)
+                    self._size = len(MAGIC)
+                data = b''.join(records)
+                stream.write(data)
+                self._size += len(data)
+        finally:
+            if fd is not None:
+                os.close(fd)
+                os.unlink(lock_path)
+
+    def _index_commits(self, repository, oids):
+        """ Add the specified commits and all their ancestors to the index
+        in memory and return the records to append to its file.
+
+        """
+        records = []
+        stack = [oid for oid in oids if oid.raw not in self._index]
+        while stack:
+            oid = stack[-1]
+            if oid.raw in self._index:
+                stack.pop()
+                continue
+            commit = repository[oid]
+            missing = [
+                parent for parent in commit.parent_ids
+                if parent.raw not in self._index]
+            if missing:
+                # Index the parents first
+                stack.extend(missing)
+                continue
+            stack.pop()
+
+            parents = [self._index[parent.raw] for parent in commit.parent_ids]
+            generation = 1 + max(
+                [self.generations[parent] for parent in parents] or [0])
+            self._append(oid.raw, generation, parents)
+            records.append(
+                oid.raw
+                + struct.pack('<IB', generation, len(parents))
+                + struct.pack('<%dI' % len(parents), *parents))
+
+        return records
+
+    def is_ancestor(self, ancestor, descendant):
+        """ Return whether the commit at the position `ancestor` can be
+        reached from the one at the position `descendant`.
+
+        """
+        if ancestor == descendant:
+            return True
+
+        min_generation = self.generations[ancestor]
+        seen = set([descendant])
+        stack = [descendant]
+        while stack:
+            idx = stack.pop()
+            for parent in self.parents(idx):
+                if parent == ancestor:
+                    return True
+                # The ancestors of this commit all have a lower generation
+                # than the one we look for
+                if parent in seen \
+                        or self.generations[parent] <= min_generation:
+                    continue
+                seen.add(parent)
+                stack.append(parent)
+        return False
+
+    def merge_bases(self, one, two):
+        """ Return the positions of the best common ancestors of the
+        commits at the positions `one` and `two`.
+
+        The history is walked by decreasing generation from both commits
+        until all the commits left to visit are known to be ancestors of a
+        common ancestor already found.
+
+        """
+        if one == two:
+            return [one]
+
+        flags = {one: PARENT1, two: PARENT2}
+        queue = [
+            (-self.generations[one], one), (-self.generations[two], two)]
+        heapq.heapify(queue)
+
+        results = []
+        while any(not flags[idx] & STALE for _, idx in queue):
+            _, idx = heapq.heappop(queue)
+            flag = flags[idx]
+            if flag & (PARENT1 | PARENT2) == PARENT1 | PARENT2:
+                if not flag & STALE:
+                    results.append(idx)
+                flag |= STALE
+                flags[idx] = flag
+            for parent in self.parents(idx):
+                if flags.get(parent, 0) & flag == flag:
+                    continue
+                if parent not in flags:
+                    heapq.heappush(queue, (-self.generations[parent], parent))
+                flags[parent] = flags.get(parent, 0) | flag
+
+        # Remove the common ancestors that are ancestors of another one
+        return [
+            idx for idx in results
+            if not any(
+                other != idx and self.is_ancestor(idx, other)
+                for other in results)
+        ]
+
+    def ahead_behind(self, pairs):
+        """ Return the number of commits each commit of the specified pairs
+        has that the other one has not, walking the history only once for
+        all the pairs.
+
+        Every commit reached is painted with the set of commits of the
+        pairs it can be reached from, the walk stops once all the commits
+        left to visit can be reached from all of them.
+
+        :arg pairs: the list of tuples (one, two) of positions of commits
+        :type pairs: list(tuple(int, int))
+        :return: the list of tuples (ahead, behind) for each pair, ahead
+            being the number of commits reachable from `one` but not from
+            `two` and behind the opposite
+        :rtype: list(tuple(int, int))
+
+        """
+        bits = {}
+        for one, two in pairs:
+            for idx in [one, two]:
+                if idx not in bits:
+                    bits[idx] = 1 << len(bits)
+        full = (1 << len(bits)) - 1
+
+        masks = dict(bits)
+        queue = [(-self.generations[idx], idx) for idx in masks]
+        heapq.heapify(queue)
+        pending = set(idx for idx in masks if masks[idx] != full)
+
+        while pending:
+            _, idx = heapq.heappop(queue)
+            pending.discard(idx)
+            mask = masks[idx]
+            for parent in self.parents(idx):
+                parent_mask = masks.get(parent)
+                if parent_mask is None:
+                    masks[parent] = mask
+                    heapq.heappush(queue, (-self.generations[parent], parent))
+                    if mask != full:
+                        pending.add(parent)
+                elif parent_mask | mask != parent_mask:
+                    masks[parent] = parent_mask | mask
+                    if masks[parent] == full:
+                        pending.discard(parent)
+
+        results = []
+        for one, two in pairs:
+            bit_one = bits[one]
+            bit_two = bits[two]
+            ahead = behind = 0
+            for mask in masks.values():
+                if mask & bit_one and not mask & bit_two:
+                    ahead += 1
+                elif mask & bit_two and not mask & bit_one:
+                    behind += 1
+            results.append((ahead, behind))
+        return results
@@ -0,0 +1,166 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+This module presents the pool of `GitRepo` objects used by pygit2_utils.
+
+Keeping the `GitRepo` objects opened allows to re-use the caches of
+libgit2 (objects, pack indexes...) from one use of the repository to the
+next one.
+
+"""
+
+import collections
+import os
+import threading
+import time
+
+
+class RepoPool(object):
+    """ A thread-safe pool of `GitRepo` objects keyed by the path of the
+    repository.
+
+    The least recently used repositories are evicted when the pool is full
+    or when they have not been used for more than `idle_timeout` seconds.
+
+    The same `GitRepo` object is returned to every caller asking for a
+    repository, without any lease. Only the lazy opening of its repository
+    and configuration is thread-safe, its caches (status, configuration,
+    references...) are not: threads sharing a pooled object have to
+    serialize their use of it, or use a pool each.
+    """
+
+    def __init__(self, max_size=32, idle_timeout=None):
+        """ Constructor of the RepoPool class.
+
+        :kwarg max_size: the maximum number of repositories kept opened in
+            the pool. Defaults to 32.
+        :type max_size: int
+        :kwarg idle_timeout: the number of seconds after which a repository
+            not used is evicted from the pool. Defaults to None, in which
+            case the repositories are only evicted when the pool is full.
+        :type idle_timeout: int or float
+        :raises ValueError: when the maximum size specified is lower than 1
+
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be greater than 0')
+
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._repos = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._repos)
+
+    def __contains__(self, path):
+        return self._key(path) in self._repos
+
+    @staticmethod
+    def _key(path):
+        """ Return the key used in the pool for the specified path. """
+        return os.path.realpath(os.path.abspath(path))
+
+    @property
+    def stats(self):
+        """ Return the statistics of the pool as a dictionary. """
+        return {
+            'size': len(self._repos),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _prune(self, now):
+        """ Evict the repositories which have been idle for too long.
+        Has to be called with the lock held.
+        """
+        if self.idle_timeout is None:
+            return
+        # The repositories are sorted from the least to the most recently
+        # used, so we can stop at the first one which is not idle.
+        while self._repos:
+            key, (repo, last_used) = next(iter(self._repos.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self._repos[key]
+            self.evictions += 1
+
+    def prune(self):
+        """ Evict the repositories which have not been used for more than
+        `idle_timeout` seconds.
+
+        """
+        with self._lock:
+            self._prune(time.time())
+
+    def get(self, path, factory):
+        """ Return the repository at the specified path, opening it using
+        the specified factory if it is not already in the pool.
+
+        :arg path: the path of the git repo on the filesystem
+        :type path: str
+        :arg factory: the callable used to open the repository if it is not
+            in the pool, it is called with the path as only argument
+        :type factory: callable
+        :return: the repository found in or added to the pool, which may be
+            in use by other threads at the same time
+        :rtype: GitRepo
+
+        """
+        key = self._key(path)
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            if key in self._repos:
+                repo = self._repos.pop(key)[0]
+                self._repos[key] = (repo, now)
+                self.hits += 1
+                return repo
+            self.misses += 1
+
+        # Open the repository outside of the lock, if two threads open the
+        # same repository at the same time, the last one wins.
+        repo = factory(path)
+
+        with self._lock:
+            self._repos.pop(key, None)
+            self._repos[key] = (repo, now)
+            while len(self._repos) > self.max_size:
+                self._repos.popitem(last=False)
+                self.evictions += 1
+
+        return repo
+
+    def discard(self, path):
+        """ Remove the repository at the specified path from the pool.
+
+        :arg path: the path of the git repo on the filesystem
+        :type path: str
+
+        """
+        with self._lock:
+            self._repos.pop(self._key(path), None)
+
+    def clear(self):
+        """ Remove all the repositories from the pool.
+
+        """
+        with self._lock:
+            self._repos.clear()
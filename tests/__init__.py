@@ -149,3 +149,67 @@ class BaseTests(unittest.TestCase):
             repo.create_tag(
                 'v%s' % i, commitid, pygit2.GIT_OBJ_COMMIT, author,
                 'tag v%s' % i)
+
+    def add_subdirectory(self):
+        """ Add a commit creating a `pkg` sub-directory in the test repo.
+        """
+
+        git_repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2.Repository(git_repo_path)
+
+        os.makedirs(os.path.join(git_repo_path, 'pkg', 'lib'))
+        for filename in ['pkg/setup', 'pkg/lib/mod']:
+            with open(os.path.join(git_repo_path, filename), 'w') as stream:
+                stream.write('%s\n' % filename)
+            repo.index.add(filename)
+        repo.index.write()
+
+        tree = repo.index.write_tree()
+        parent = repo.revparse_single('HEAD').oid.hex
+
+        author = pygit2.Signature('Alice Author', 'alice@authors.tld')
+        repo.create_commit(
+            'refs/heads/master',
+            author,
+            author,
+            'Add the pkg sub-directory',
+            tree,
+            [parent]
+        )
+
+    def add_merge_commit(self):
+        """ Add a merge commit to the test repo, merging a `feature` branch
+        changing the second and fifth lines of `sources` into `master`
+        changing its fifth and ninth lines, the merge itself changing the
+        fifth line once more.
+        """
+
+        git_repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2.Repository(git_repo_path)
+        author = pygit2.Signature('Alice Author', 'alice@authors.tld')
+
+        def _commit(ref, lines, parents, message):
+            builder = repo.TreeBuilder(repo[parents[0]].tree)
+            blob = repo.create_blob(('\n'.join(lines) + '\n').encode())
+            builder.insert('sources', blob, pygit2.GIT_FILEMODE_BLOB)
+            return repo.create_commit(
+                ref, author, author, message, builder.write(), parents)
+
+        lines = list('abcdefghij')
+        base = _commit(
+            'refs/heads/master', lines,
+            [repo.revparse_single('HEAD').oid], 'Base')
+
+        lines[1] = 'B'
+        lines[4] = 'feature'
+        feature = _commit(
+            'refs/heads/feature', lines, [base], 'Feature')
+
+        lines = list('abcdefghij')
+        lines[4] = 'master'
+        lines[8] = 'I'
+        master = _commit('refs/heads/master', lines, [base], 'Master')
+
+        lines = list('aBcdEfghIj')
+        return _commit(
+            'refs/heads/master', lines, [master, feature], 'Merge feature')
@@ -0,0 +1,75 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import pygit2_utils
+
+
+class CacheTests(unittest.TestCase):
+    """ LRUCache tests. """
+
+    def test_lru_cache(self):
+        """ Test the pygit2_utils.LRUCache storing and evicting entries
+        """
+        cache = pygit2_utils.LRUCache(max_bytes=10)
+
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', 'bar'), 'bar')
+
+        cache.set('foo', 'foo', 4)
+        cache.set('bar', 'bar', 4)
+        self.assertEqual(cache.get('foo'), 'foo')
+        self.assertEqual(cache.size, 8)
+
+        # `bar` is the least recently used entry, it is evicted
+        cache.set('baz', 'baz', 4)
+        self.assertFalse('bar' in cache)
+        self.assertTrue('foo' in cache)
+        self.assertTrue('baz' in cache)
+
+        # Values larger than the cache are not stored
+        cache.set('big', 'big', 11)
+        self.assertFalse('big' in cache)
+
+        self.assertEqual(
+            cache.stats,
+            {'entries': 2, 'size': 8, 'max_bytes': 10, 'hits': 1,
+             'misses': 2, 'evictions': 1})
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_lru_cache_max_entries(self):
+        """ Test the pygit2_utils.LRUCache bounding its number of entries
+        """
+        cache = pygit2_utils.LRUCache(max_entries=2)
+
+        for i in range(3):
+            cache.set(i, i)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(0 in cache)
+        self.assertEqual(cache.evictions, 1)
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(CacheTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
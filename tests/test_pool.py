@@ -0,0 +1,114 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import pygit2_utils
+
+from tests import BaseTests
+
+
+class PoolTests(BaseTests):
+    """ RepoPool tests. """
+
+    def test_repo_pool(self):
+        """ Test the pygit2_utils.RepoPool re-using and evicting the
+        repositories
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        bare_repo_path = os.path.join(self.gitroot, 'test_repo.git')
+
+        # Fails: size invalid
+        self.assertRaises(ValueError, pygit2_utils.RepoPool, 0)
+
+        pool = pygit2_utils.RepoPool(max_size=1)
+
+        repo = pool.get(repo_path, pygit2_utils.GitRepo)
+        self.assertTrue(isinstance(repo, pygit2_utils.GitRepo))
+        self.assertTrue(repo_path in pool)
+        self.assertTrue(
+            pool.get(repo_path + '/', pygit2_utils.GitRepo) is repo)
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 1)
+
+        # The pool is full, the least recently used repo is evicted
+        pool.get(bare_repo_path, pygit2_utils.GitRepo)
+        self.assertFalse(repo_path in pool)
+        self.assertTrue(bare_repo_path in pool)
+        self.assertEqual(
+            pool.stats,
+            {'size': 1, 'max_size': 1, 'hits': 1, 'misses': 2,
+             'evictions': 1})
+
+        self.assertFalse(pool.get(repo_path, pygit2_utils.GitRepo) is repo)
+
+        pool.discard(repo_path)
+        self.assertEqual(len(pool), 0)
+
+    def test_repo_pool_idle_timeout(self):
+        """ Test the pygit2_utils.RepoPool evicting the repositories not
+        used for too long
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+
+        pool = pygit2_utils.RepoPool(idle_timeout=0.01)
+        pool.get(repo_path, pygit2_utils.GitRepo)
+        self.assertEqual(len(pool), 1)
+
+        time.sleep(0.02)
+        pool.prune()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.evictions, 1)
+
+    def test_open_pooled(self):
+        """ Test the pygit2_utils.GitRepo.open_pooled returning the same
+        GitRepo for the same path
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+
+        # Fails: path invalid
+        self.assertRaises(
+            OSError,
+            pygit2_utils.GitRepo.open_pooled,
+            os.path.join(self.gitroot, 'foo'),
+        )
+
+        repo = pygit2_utils.GitRepo.open_pooled(repo_path)
+        self.assertTrue(pygit2_utils.GitRepo.open_pooled(repo_path) is repo)
+        self.assertTrue(repo_path in pygit2_utils.DEFAULT_POOL)
+
+        pool = pygit2_utils.RepoPool()
+        other = pygit2_utils.GitRepo.open_pooled(repo_path, pool=pool)
+        self.assertFalse(other is repo)
+        self.assertEqual(other.current_branch, 'master')
+
+        pygit2_utils.DEFAULT_POOL.discard(repo_path)
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(PoolTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -13,9 +13,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import io
+import pickle
 import unittest
 import sys
+import shutil
 import os
+import time
 
 import pygit2
 
@@ -43,6 +47,37 @@ class ScmTests(BaseTests):
 
         )
 
+    def test_gitrepo_lazy(self):
+        """ Test the pygit2_utils.GitRepo() constructor deferring the
+        opening of the repository
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+
+        # Fails: path invalid, even lazily
+        self.assertRaises(
+            OSError,
+            pygit2_utils.GitRepo,
+            os.path.join(self.gitroot, 'foo'),
+            lazy=True,
+        )
+
+        repo = pygit2_utils.GitRepo(repo_path, lazy=True)
+        self.assertEqual(repo.path, repo_path)
+        self.assertEqual(repo._repository, None)
+        self.assertEqual(repo._config, None)
+
+        self.assertEqual(repo.current_branch, 'master')
+        self.assertTrue(isinstance(repo.repository, pygit2.Repository))
+        self.assertEqual(repo._config, None)
+        self.assertEqual(repo.get_config('user.name'), 'foo')
+
+        # The repository is re-opened once unpickled
+        repo = pickle.loads(pickle.dumps(repo))
+        self.assertEqual(repo._repository, None)
+        self.assertEqual(repo.current_branch, 'master')
+
     def test_clone_repo(self):
         """ Test the pygit2_utils.clone_repo to clone a repo """
         self.setup_git_repo()
@@ -79,6 +114,58 @@ class ScmTests(BaseTests):
             os.path.exists(os.path.join(git_repo_path, '.git'))
         )
 
+    def test_clone_repo_options(self):
+        """ Test the pygit2_utils.clone_repo to clone a repo partially, from
+        a reference repo and reporting its progress """
+        self.setup_git_repo()
+
+        bare_repo_path = os.path.join(self.gitroot, 'test_repo.git')
+        bare_repo = pygit2.Repository(bare_repo_path)
+        bare_repo.create_branch(
+            'feature', bare_repo[bare_repo.head.target])
+
+        # Single branch
+        repo = pygit2_utils.GitRepo.clone_repo(
+            bare_repo_path, os.path.join(self.gitroot, 'single'),
+            branch='feature', single_branch=True, depth=1)
+        self.assertEqual(repo.current_branch, 'feature')
+        self.assertEqual(repo.list_branches(), ['feature', 'origin/feature'])
+
+        repo = pygit2_utils.GitRepo.clone_repo(
+            bare_repo_path, os.path.join(self.gitroot, 'single_head'),
+            bare=True, single_branch=True)
+        self.assertEqual(repo.current_branch, 'master')
+        self.assertEqual(repo.list_branches('remote'), ['origin/master'])
+
+        # Objects fetched instead of hardlinked, reporting the progress
+        progress = []
+        repo = pygit2_utils.GitRepo.clone_repo(
+            bare_repo_path, os.path.join(self.gitroot, 'fetched'),
+            local=False, progress=progress.append)
+        self.assertTrue(len(progress) > 0)
+        last = progress[-1]
+        self.assertTrue(isinstance(last, pygit2_utils.CloneProgress))
+        self.assertEqual(last.received_objects, last.total_objects)
+        self.assertTrue(last.received_bytes > 0)
+        self.assertTrue(last.throughput >= 0)
+        self.assertEqual(
+            sorted(repo.list_branches()),
+            ['master', 'origin/feature', 'origin/master'])
+
+        # Objects used from a reference repo
+        progress = []
+        repo = pygit2_utils.GitRepo.clone_repo(
+            bare_repo_path, os.path.join(self.gitroot, 'referenced'),
+            reference=bare_repo_path, progress=progress.append)
+        objects_path = os.path.join(repo.repository.path, 'objects')
+        with open(os.path.join(objects_path, 'info', 'alternates')) as stream:
+            self.assertEqual(
+                stream.read().strip(),
+                os.path.join(bare_repo.path, 'objects').rstrip('/'))
+        self.assertEqual(os.listdir(os.path.join(objects_path, 'pack')), [])
+        self.assertEqual(
+            repo.head_of_branch('master').oid, bare_repo.head.target)
+
     def test_current_branch(self):
         """ Test the pygit2_utils.GitRepo().current_branch returning the
         current branch
@@ -111,6 +198,81 @@ class ScmTests(BaseTests):
 
         self.assertEqual(repo.remote_current_branch, None)
 
+    def test_ref_snapshot(self):
+        """ Test the pygit2_utils.GitRepo().ref_snapshot returning all the
+        references of the repo read at once
+        """
+        self.setup_git_repo()
+        self.add_branches()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        head = repo.repository.head.target.hex
+
+        snapshot = repo.ref_snapshot()
+        self.assertEqual(snapshot.head, 'ref: refs/heads/master')
+        self.assertEqual(
+            snapshot.names('refs/heads/'),
+            ['refs/heads/foo0', 'refs/heads/foo1', 'refs/heads/master'])
+        self.assertEqual(snapshot.resolve('HEAD'), head)
+        self.assertEqual(snapshot.resolve('refs/heads/foo1'), head)
+        self.assertEqual(snapshot.resolve('refs/heads/foo'), None)
+
+        # Nothing changed: the snapshot is re-used by every lookup
+        self.assertEqual(repo.current_branch, 'master')
+        self.assertEqual(repo.remote_current_branch, 'origin/master')
+        self.assertEqual(repo.head_of_branch('foo0').oid.hex, head)
+        self.assertEqual(
+            repo.list_branches('local'), ['foo0', 'foo1', 'master'])
+        self.assertEqual(repo.list_tags(), [])
+        self.assertTrue(repo.ref_snapshot() is snapshot)
+
+        # Adding a reference invalidates the snapshot
+        self.add_tags()
+        snapshot = repo.ref_snapshot()
+        self.assertEqual(repo.list_tags(), ['v0', 'v1'])
+        self.assertEqual(
+            repo.head_of_branch('master').oid.hex,
+            repo.repository.head.target.hex)
+
+        # Packed references are read as well, the loose ones taking
+        # precedence
+        with open(os.path.join(
+                repo.repository.path, 'packed-refs'), 'w') as stream:
+            stream.write(
+                '%s refs/heads/foo0\n%s refs/heads/packed\n' % (
+                    '0' * 40, head))
+        self.assertEqual(repo.head_of_branch('packed').oid.hex, head)
+        self.assertEqual(repo.head_of_branch('foo0').oid.hex, head)
+        self.assertRaises(
+            pygit2_utils.exceptions.NoSuchBranchError,
+            repo.head_of_branch, 'foo')
+
+        # Force a new read
+        snapshot = repo.ref_snapshot()
+        self.assertFalse(repo.ref_snapshot(refresh=True) is snapshot)
+
+        # In a linked worktree, the references are the ones of the repo but
+        # HEAD is the one of the worktree
+        worktree_path = os.path.join(self.gitroot, 'worktree')
+        repo.repository.add_worktree(
+            'worktree', worktree_path,
+            repo.repository.lookup_reference('refs/heads/foo1'))
+        worktree = pygit2_utils.GitRepo(worktree_path)
+        snapshot = worktree.ref_snapshot()
+        self.assertEqual(snapshot.head, 'ref: refs/heads/foo1')
+        self.assertEqual(
+            snapshot.names('refs/heads/'),
+            ['refs/heads/foo0', 'refs/heads/foo1', 'refs/heads/master',
+             'refs/heads/packed'])
+        self.assertEqual(worktree.current_branch, 'foo1')
+        self.assertEqual(repo.current_branch, 'master')
+        self.assertEqual(
+            worktree.list_branches('local'),
+            ['foo0', 'foo1', 'master', 'packed'])
+        self.assertEqual(worktree.list_tags(), ['v0', 'v1'])
+        self.assertEqual(worktree.head_of_branch('packed').oid.hex, head)
+
     def test_files_changed(self):
         """ Test the pygit2_utils.GitRepo().files_changed returning the
         list of files tracked that have changed locally
@@ -132,6 +294,19 @@ class ScmTests(BaseTests):
             ['.gitignore', 'sources']
         )
 
+        # Files changed in place, or added in a sub-directory, are seen
+        self.add_subdirectory()
+        self.assertEqual(
+            sorted(repo.files_changed), ['.gitignore', 'sources'])
+        with open(os.path.join(repo_path, 'pkg', 'setup'), 'w') as stream:
+            stream.write('changed')
+        with open(os.path.join(repo_path, 'pkg', 'new'), 'w') as stream:
+            stream.write('new')
+        self.assertEqual(
+            sorted(repo.files_changed),
+            ['.gitignore', 'pkg/setup', 'sources'])
+        self.assertEqual(sorted(repo.files_untracked), ['bar', 'pkg/new'])
+
     def test_files_untracked(self):
         """ Test the pygit2_utils.GitRepo().files_untracked returning the
         list of files not tracked but present locally
@@ -151,6 +326,182 @@ class ScmTests(BaseTests):
             ['bar']
         )
 
+    def test_status_snapshot(self):
+        """ Test the pygit2_utils.GitRepo().status_snapshot returning the
+        status of the working tree in one scan
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        with open(os.path.join(repo_path, 'sources'), 'w') as stream:
+            stream.write('\nBoo!!2')
+        with open(os.path.join(repo_path, 'bar'), 'w') as stream:
+            stream.write('blah')
+        os.unlink(os.path.join(repo_path, '.gitignore'))
+
+        snapshot = repo.status_snapshot()
+        self.assertEqual(snapshot.modified, ['sources'])
+        self.assertEqual(snapshot.deleted, ['.gitignore'])
+        self.assertEqual(snapshot.new, ['bar'])
+        self.assertEqual(snapshot.staged, [])
+        self.assertEqual(snapshot.renamed, [])
+
+        # Nothing changed: the snapshot is re-used
+        self.assertTrue(repo.status_snapshot() is snapshot)
+
+        # Adding a file at the root invalidates the snapshot
+        with open(os.path.join(repo_path, 'foo'), 'w') as stream:
+            stream.write('blah')
+        self.assertEqual(
+            sorted(repo.status_snapshot().new), ['bar', 'foo'])
+
+        # Once paths are watched, the properties use the snapshot as well
+        repo.status_watch = [repo_path]
+        self.assertTrue(repo.status_snapshot() is repo.status_snapshot())
+        self.assertEqual(sorted(repo.files_untracked), ['bar', 'foo'])
+
+        # Staging a file invalidates the snapshot
+        repo.repository.index.add('bar')
+        repo.repository.index.write()
+        snapshot = repo.status_snapshot()
+        self.assertEqual(snapshot.staged, ['bar'])
+        self.assertEqual(snapshot.new, ['foo'])
+
+        # Force a new scan
+        self.assertFalse(repo.status_snapshot(refresh=True) is snapshot)
+
+    def test_iter_status(self):
+        """ Test the pygit2_utils.GitRepo().iter_status method and its
+        list_files_changed and list_files_untracked wrappers restricting
+        the status to some paths
+        """
+        self.setup_git_repo()
+        self.add_subdirectory()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        # Fails: untracked mode invalid
+        self.assertRaises(
+            ValueError,
+            list,
+            repo.iter_status(untracked='foo'),
+        )
+
+        with open(os.path.join(repo_path, 'sources'), 'w') as stream:
+            stream.write('\nBoo!!2')
+        with open(os.path.join(repo_path, 'pkg', 'lib', 'mod'), 'w') as stream:
+            stream.write('changed')
+        os.unlink(os.path.join(repo_path, 'pkg', 'setup'))
+        os.makedirs(os.path.join(repo_path, 'pkg', 'build', 'out'))
+        with open(os.path.join(
+                repo_path, 'pkg', 'build', 'out', 'bin'), 'w') as stream:
+            stream.write('blah')
+        with open(os.path.join(repo_path, 'bar'), 'w') as stream:
+            stream.write('blah')
+
+        status = dict(repo.iter_status('pkg'))
+        self.assertEqual(
+            sorted(status),
+            ['pkg/build/out/bin', 'pkg/lib/mod', 'pkg/setup'])
+        self.assertEqual(
+            status['pkg/lib/mod'], pygit2.GIT_STATUS_WT_MODIFIED)
+        self.assertEqual(status['pkg/setup'], pygit2.GIT_STATUS_WT_DELETED)
+        self.assertEqual(
+            status['pkg/build/out/bin'], pygit2.GIT_STATUS_WT_NEW)
+
+        self.assertEqual(
+            sorted(repo.list_files_changed('pkg')),
+            ['pkg/lib/mod', 'pkg/setup'])
+        self.assertEqual(
+            repo.list_files_changed(['pkg/lib', 'sources']),
+            ['pkg/lib/mod', 'sources'])
+        self.assertEqual(
+            sorted(repo.list_files_changed()),
+            ['pkg/lib/mod', 'pkg/setup', 'sources'])
+
+        self.assertEqual(
+            repo.list_files_untracked('pkg'), ['pkg/build/out/bin'])
+        self.assertEqual(
+            repo.list_files_untracked('pkg', recurse=False), ['pkg/build/'])
+        self.assertEqual(
+            sorted(repo.list_files_untracked(recurse=False)),
+            ['bar', 'pkg/build/'])
+        self.assertEqual(repo.list_files_untracked('pkg/lib'), [])
+        self.assertEqual(repo.list_files_untracked('bar'), ['bar'])
+        self.assertEqual(repo.list_files_changed('bar'), [])
+        self.assertEqual(repo.list_files_changed('pkg/setup'), ['pkg/setup'])
+
+        # Ignored files are reported by none of the modes
+        with open(os.path.join(
+                repo.repository.path, 'info', 'exclude'), 'w') as stream:
+            stream.write('build/\n*.o\n')
+        with open(os.path.join(repo_path, 'pkg', 'lib', 'mod.o'), 'w') \
+                as stream:
+            stream.write('blah')
+        for untracked in ['all', 'normal', 'no']:
+            expected = list(repo.iter_status('pkg', untracked=untracked))
+            expected.append(('sources', pygit2.GIT_STATUS_WT_MODIFIED))
+            if untracked != 'no':
+                expected.append(('bar', pygit2.GIT_STATUS_WT_NEW))
+            self.assertEqual(
+                sorted(repo.iter_status(untracked=untracked)),
+                sorted(expected))
+        self.assertEqual(repo.list_files_untracked('pkg/lib/mod.o'), [])
+        self.assertEqual(repo.list_files_untracked('pkg'), [])
+
+        # A directory removed is still reported file by file
+        shutil.rmtree(os.path.join(repo_path, 'pkg'))
+        self.assertEqual(
+            sorted(repo.list_files_changed('pkg')),
+            ['pkg/lib/mod', 'pkg/setup'])
+        self.assertEqual(
+            repo.list_files_changed('pkg/lib/mod'), ['pkg/lib/mod'])
+        self.assertEqual(repo.list_files_changed('pkg/lib/foo'), [])
+
+    def test_get_config(self):
+        """ Test the pygit2_utils.GitRepo().get_config and get_config_many
+        methods returning cached configuration values
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        self.assertEqual(repo.get_config('user.name'), 'foo')
+        self.assertEqual(
+            repo.get_config_many(['user.name', 'user.email', 'foo.bar']),
+            {'user.name': 'foo', 'user.email': 'foo@bar.com'})
+
+        # The values are cached
+        snapshot = repo._config_snapshot()
+        self.assertEqual(snapshot['user.email'], 'foo@bar.com')
+
+        # Changing the configuration invalidates the cache
+        config_path = os.path.join(repo_path, '.git', 'config')
+        with open(config_path) as stream:
+            config = stream.read()
+        with open(config_path, 'w') as stream:
+            stream.write(config.replace('name = foo', 'name = bar'))
+        stat = os.stat(config_path)
+        os.utime(config_path, (stat.st_atime, stat.st_mtime + 10))
+
+        self.assertEqual(repo.get_config('user.name'), 'bar')
+        self.assertEqual(
+            repo._signature(useremail='bar@foo.com').email, 'bar@foo.com')
+        self.assertEqual(repo._signature().name, 'bar')
+
+        # The signature is not cached among the configuration values
+        self.assertEqual(repo.get_config_many(['__signature__']), {})
+
+        # Several missing keys are read at once, their case is ignored
+        repo._config_snapshot().clear()
+        self.assertEqual(
+            repo.get_config_many(['User.Name', 'user.email', 'foo.bar']),
+            {'User.Name': 'bar', 'user.email': 'foo@bar.com'})
+
     def test_commit(self):
         """ Test the pygit2_utils.GitRepo().commit returning the commit
         """
@@ -215,6 +566,142 @@ class ScmTests(BaseTests):
         self.assertEqual(commit.author.name, 'bar')
         self.assertEqual(commit.author.email, 'bar@foo.com')
 
+    def test_commit_contents(self):
+        """ Test the pygit2_utils.GitRepo().commit_contents committing
+        contents without using the working tree nor the index
+        """
+        self.setup_git_repo()
+        self.add_subdirectory()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        repo_obj = pygit2.Repository(repo_path)
+        head = repo_obj.revparse_single('HEAD').oid.hex
+
+        # Fails: parent invalid
+        self.assertRaises(
+            KeyError,
+            repo.commit_contents,
+            'Commit from the tests',
+            {'sources': b'foo'},
+            parent='8f167d70462b088e00b',
+        )
+
+        commitid = repo.commit_contents(
+            'Commit from the tests',
+            {
+                'sources': b'new sources\n',
+                'pkg/lib/new/file': io.BytesIO(b'new file\n'),
+                'pkg/setup': None,
+            },
+            username='bar', useremail='bar@foo.com')
+
+        commit = repo_obj.revparse_single('HEAD')
+        self.assertEqual(commitid.hex, commit.oid.hex)
+        self.assertEqual(commit.parents[0].oid.hex, head)
+        self.assertEqual(commit.message, 'Commit from the tests')
+        self.assertEqual(commit.author.name, 'bar')
+        self.assertEqual(
+            repo_obj[commit.tree['sources'].oid].data, b'new sources\n')
+        self.assertEqual(
+            repo_obj[commit.tree['pkg/lib/new/file'].oid].data,
+            b'new file\n')
+        self.assertEqual(
+            repo_obj[commit.tree['pkg/lib/mod'].oid].data, b'pkg/lib/mod\n')
+        self.assertFalse('setup' in repo_obj[commit.tree['pkg'].oid])
+
+        # The working tree and the index are untouched
+        self.assertEqual(repo.files_changed, [])
+        self.assertTrue(
+            os.path.exists(os.path.join(repo_path, 'pkg', 'setup')))
+
+        # Removing all the files of a directory removes the directory
+        repo.commit_contents(
+            'Remove pkg', {'pkg/lib/mod': None, 'pkg/lib/new/file': None})
+        commit = repo_obj.revparse_single('HEAD')
+        self.assertFalse('pkg' in commit.tree)
+
+        # Deleting under a missing directory does not create it
+        repo.commit_contents(
+            'Nothing to remove', {'nodir/x': None, 'nodir/sub/y': None,
+                                  'other': b'other'})
+        commit = repo_obj.revparse_single('HEAD')
+        self.assertFalse('nodir' in commit.tree)
+        self.assertTrue('other' in commit.tree)
+
+        # Works on bare repositories
+        bare_repo_path = os.path.join(self.gitroot, 'test_repo.git')
+        bare_repo = pygit2_utils.GitRepo(bare_repo_path)
+        commitid = bare_repo.commit_contents(
+            'Commit in a bare repo', {'foo/bar': b'bar'}, parent='master',
+            branch='feature', username='bar', useremail='bar@foo.com')
+        bare_repo_obj = pygit2.Repository(bare_repo_path)
+        commit = bare_repo_obj.revparse_single('feature')
+        self.assertEqual(commit.oid.hex, commitid.hex)
+        self.assertEqual(
+            sorted(entry.name for entry in commit.tree),
+            ['.gitignore', 'foo', 'sources'])
+
+    def test_commit_batch(self):
+        """ Test the pygit2_utils.GitRepo().commit_batch stacking commits
+        and moving the branch once
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        repo_obj = pygit2.Repository(repo_path)
+        head = repo_obj.revparse_single('HEAD').oid.hex
+
+        with repo.commit_batch() as batch:
+            for i in range(3):
+                batch.commit(
+                    'Commit %s' % i, {'sources': ('%s\n' % i).encode()})
+            # The branch is not moved until the end of the batch
+            self.assertEqual(repo_obj.revparse_single('HEAD').oid.hex, head)
+
+        self.assertEqual(len(batch.commits), 3)
+        commit = repo_obj.revparse_single('HEAD')
+        self.assertEqual(commit.oid.hex, batch.commits[-1].hex)
+        self.assertEqual(commit.message, 'Commit 2')
+        self.assertEqual(commit.author.name, 'foo')
+        self.assertEqual(
+            repo_obj.revparse_single('HEAD~2').parents[0].oid.hex, head)
+        self.assertEqual(repo_obj[commit.tree['sources'].oid].data, b'2\n')
+
+        # Fails: the branch moved during the batch
+        head = commit.oid.hex
+        batch = repo.commit_batch(username='bar', useremail='bar@foo.com')
+        batch.commit('Batched commit', {'sources': b'batch'})
+        repo.commit_contents('Concurrent commit', {'sources': b'other'})
+        self.assertRaises(
+            pygit2_utils.exceptions.ReferenceChangedError,
+            batch.finish,
+        )
+
+        # Nothing is updated when the batch fails
+        try:
+            with repo.commit_batch('feature', parent=head) as batch:
+                batch.commit('Batched commit', {'sources': b'batch'})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(repo_obj.lookup_branch('feature'), None)
+
+        # Fails: the parent does not descend from the tip of the branch
+        self.assertRaises(
+            pygit2_utils.exceptions.ReferenceChangedError,
+            repo.commit_batch,
+            parent=head,
+        )
+
+        # Works: the parent descends from the tip of the branch
+        tip = repo_obj.revparse_single('master').oid.hex
+        with repo.commit_batch(parent=tip) as batch:
+            batch.commit('On the tip', {'sources': b'tip'})
+        self.assertEqual(
+            repo_obj.revparse_single('master~1').oid.hex, tip)
+
     def test_diff_head(self):
         """ Test the pygit2_utils.GitRepo().diff returning the diff against
         HEAD
@@ -385,6 +872,600 @@ index e69de29..fa457ba 100644
         diff = repo.diff(commitid2, commitid)
         self.assertEqual(diff.patch, exp)
 
+    def test_diff_merge(self):
+        """ Test the pygit2_utils.GitRepo().diff returning the diff of a
+        merge commit
+        """
+        self.setup_git_repo()
+        commitid = self.add_merge_commit().hex
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        # Fails: merge diff mode invalid
+        self.assertRaises(
+            ValueError,
+            repo.diff,
+            commitid,
+            merge_diff_mode='foo'
+        )
+
+        self.assertEqual(repo.diff(commitid), '')
+
+        diff = repo.diff(commitid, merge_diff_mode='first-parent')
+        self.assertEqual(
+            diff.patch,
+            repo.diff('%s^1' % commitid, commitid).patch)
+
+        diff = repo.diff(commitid, merge_diff_mode='per-parent')
+        self.assertEqual(len(diff.diffs), 2)
+        self.assertEqual(
+            diff.patch,
+            repo.diff('%s^1' % commitid, commitid).patch
+            + repo.diff('%s^2' % commitid, commitid).patch)
+
+        # Only the hunk changing the fifth line, which differs from both
+        # parents, is kept
+        exp = """diff --git a/sources b/sources
+index 5cd8a84..da2e870 100644
+--- a/sources
++++ b/sources
+@@ -1,8 +1,8 @@
+ a
+-b
++B
+ c
+ d
+-master
++E
+ f
+ g
+ h
+"""
+        diff = repo.diff(commitid, merge_diff_mode='combined')
+        self.assertEqual(diff.patch, exp)
+        self.assertEqual(
+            [patch.delta.new_file.path for patch in diff], ['sources'])
+
+        patch = repo.get_patch(commitid, merge_diff_mode='combined')
+        self.assertTrue(patch.endswith(exp + '\n'))
+
+        stats = repo.diff_stats(commitid, merge_diff_mode='per-parent')
+        self.assertEqual(len(stats.files), 2)
+
+        # The stats and the records only cover the hunks kept: on a longer
+        # file, the hunk brought by the second parent is dropped
+        repo_obj = pygit2.Repository(repo_path)
+        author = pygit2.Signature('Alice Author', 'alice@authors.tld')
+
+        def _commit(lines, parents):
+            builder = repo_obj.TreeBuilder(repo_obj[parents[0]].tree)
+            blob = repo_obj.create_blob(('\n'.join(lines) + '\n').encode())
+            builder.insert('long', blob, pygit2.GIT_FILEMODE_BLOB)
+            return repo_obj.create_commit(
+                None, author, author, 'Long', builder.write(), parents)
+
+        lines = ['line %s' % idx for idx in range(20)]
+        base = _commit(lines, [commitid])
+        ours = _commit(lines[:18] + ['ours'] + lines[19:], [base])
+        theirs = _commit(['theirs'] + lines[1:], [base])
+        merge = _commit(
+            ['theirs'] + lines[1:10] + ['merge'] + lines[11:18] + ['ours']
+            + lines[19:], [ours, theirs]).hex
+
+        diff = repo.diff(merge, merge_diff_mode='combined')
+        self.assertEqual(diff.patch.count('@@ -'), 1)
+        stats = repo.diff_stats(merge, merge_diff_mode='combined')
+        self.assertEqual(
+            [(stat.path, stat.additions, stat.deletions)
+             for stat in stats.files],
+            [('long', 1, 1)])
+        records = list(repo.iter_diff(merge, merge_diff_mode='combined'))
+        self.assertEqual(
+            [record.kind for record in records].count('hunk'), 1)
+        self.assertEqual(
+            ''.join(
+                record.content for record in records
+                if record.kind in ['hunk', 'line']),
+            diff.patch[diff.patch.index('@@ -'):])
+
+        # Files too large are skipped in every mode
+        lines = ['line %s' % idx for idx in range(1000)]
+        base = _commit(lines, [merge])
+        ours = _commit(['ours'] + lines[1:], [base])
+        theirs = _commit(lines[:999] + ['theirs'], [base])
+        merge = _commit(
+            ['ours'] + lines[1:500] + ['merge'] + lines[501:999]
+            + ['theirs'], [ours, theirs]).hex
+        size = len(repo_obj[repo_obj[merge].tree['long'].oid].data)
+        for mode in pygit2_utils.MERGE_DIFF_MODES:
+            records = list(repo.iter_diff(
+                merge, max_blob_size=100, merge_diff_mode=mode))
+            self.assertEqual(
+                [record.kind for record in records],
+                ['file', 'skipped'] * (2 if mode == 'per-parent' else 1))
+            self.assertTrue(all(
+                record.content >= size
+                for record in records if record.kind == 'skipped'))
+
+    def test_iter_diff(self):
+        """ Test the pygit2_utils.GitRepo().iter_diff returning the diff
+        record by record, within limits
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        first = repo.repository.revparse_single('HEAD').oid.hex
+        repo.commit_contents(
+            'Some changes',
+            {
+                'sources': ''.join('%d\n' % i for i in range(10)).encode(),
+                'big': b'x' * 1000 + b'\n',
+                'bin': b'\x00\x01',
+                '.gitignore': None,
+            }
+        )
+
+        records = list(repo.iter_diff(first, 'HEAD'))
+        self.assertEqual(
+            records[:7],
+            [
+                ('file', '.gitignore', 'D'),
+                ('file', 'big', 'A'),
+                ('hunk', 'big', '@@ -0,0 +1 @@\n'),
+                ('line', 'big', '+' + 'x' * 1000 + '\n'),
+                ('file', 'bin', 'A'),
+                ('binary', 'bin', None),
+                ('file', 'sources', 'M'),
+            ]
+        )
+        self.assertEqual(records[-1], ('line', 'sources', '+9\n'))
+        self.assertEqual(records[-1].kind, 'line')
+        self.assertEqual(len(records), 18)
+
+        # Blobs too large are not diffed
+        records = list(repo.iter_diff(first, 'HEAD', max_blob_size=100))
+        self.assertEqual(records[2], ('skipped', 'big', 1001))
+
+        # Per file limit
+        records = list(repo.iter_diff(
+            first, 'HEAD', max_file_lines=3, max_blob_size=100))
+        self.assertEqual(
+            records[-5:],
+            [
+                ('hunk', 'sources', '@@ -0,0 +1,10 @@\n'),
+                ('line', 'sources', '+0\n'),
+                ('line', 'sources', '+1\n'),
+                ('line', 'sources', '+2\n'),
+                ('truncated', 'sources', 'file'),
+            ]
+        )
+
+        records = list(repo.iter_diff(first, 'HEAD', max_file_bytes=100))
+        self.assertEqual(records[3], ('truncated', 'big', 'file'))
+        self.assertEqual(records[4], ('file', 'bin', 'A'))
+
+        # Total limit
+        records = list(repo.iter_diff(
+            first, 'HEAD', max_lines=2, max_blob_size=100))
+        self.assertEqual(
+            records[-3:],
+            [
+                ('line', 'sources', '+0\n'),
+                ('line', 'sources', '+1\n'),
+                ('truncated', None, 'total'),
+            ]
+        )
+        records = list(repo.iter_diff(first, 'HEAD', max_bytes=500))
+        self.assertEqual(records[-1], ('truncated', None, 'total'))
+        self.assertEqual(len(records), 4)
+
+    def test_diff_stats(self):
+        """ Test the pygit2_utils.GitRepo().diff_stats returning the summary
+        of a diff
+        """
+        self.setup_git_repo()
+        self.add_subdirectory()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        repo_obj = pygit2.Repository(repo_path)
+
+        # Fails: hash invalid
+        self.assertRaises(
+            pygit2_utils.exceptions.NoSuchRefError,
+            repo.diff_stats,
+            'f05c03a2054f2d203bb'
+        )
+
+        commitid = repo_obj.revparse_single('HEAD').oid.hex
+        stats = repo.diff_stats(commitid)
+        self.assertEqual(
+            stats.files,
+            [
+                ('pkg/lib/mod', 'A', 1, 0, False),
+                ('pkg/setup', 'A', 1, 0, False),
+            ]
+        )
+        self.assertEqual(stats.additions, 2)
+        self.assertEqual(stats.deletions, 0)
+
+        with open(os.path.join(repo_path, 'sources'), 'w') as stream:
+            stream.write('foo\nbar\n')
+        with open(os.path.join(repo_path, 'pkg', 'bin'), 'wb') as stream:
+            stream.write(b'\x00\x01')
+        os.unlink(os.path.join(repo_path, 'pkg', 'setup'))
+        repo.repository.index.add('pkg/bin')
+        repo.repository.index.remove('pkg/setup')
+        repo.repository.index.write()
+        commitid2 = repo.commit('Some changes', ['sources']).hex
+
+        stats = repo.diff_stats(commitid, commitid2)
+        self.assertEqual(
+            stats.files,
+            [
+                ('pkg/bin', 'A', 0, 0, True),
+                ('pkg/setup', 'D', 0, 1, False),
+                ('sources', 'M', 2, 0, False),
+            ]
+        )
+        self.assertEqual(stats.files[2].additions, 2)
+        self.assertEqual(stats.additions, 2)
+        self.assertEqual(stats.deletions, 1)
+
+    def test_diff_cache(self):
+        """ Test the pygit2_utils.GitRepo() diff cache used by diff_stats
+        and get_patch
+        """
+        self.setup_git_repo()
+        self.add_commits()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        cache = pygit2_utils.LRUCache()
+        repo = pygit2_utils.GitRepo(repo_path, diff_cache=cache)
+
+        commitid = repo.repository.revparse_single('HEAD').oid.hex
+        parentid = repo.repository.revparse_single('HEAD^').oid.hex
+
+        stats = repo.diff_stats(commitid)
+        self.assertEqual(cache.misses, 1)
+        self.assertTrue((parentid, commitid, 'stats') in cache)
+
+        # The diff of a commit is the diff with its parent
+        self.assertTrue(repo.diff_stats(commitid) is stats)
+        self.assertTrue(repo.diff_stats(parentid, commitid) is stats)
+        self.assertEqual(cache.hits, 2)
+
+        patch = repo.get_patch(commitid)
+        self.assertTrue((parentid, commitid, 'patch') in cache)
+        self.assertEqual(repo.get_patch(commitid), patch)
+        self.assertEqual(cache.hits, 3)
+
+        # The diff with the working tree is not cached
+        repo.diff_stats()
+        self.assertEqual(len(cache), 2)
+
+        # The cache can be shared between repositories
+        other = pygit2_utils.GitRepo(
+            os.path.join(self.gitroot, 'test_repo'), diff_cache=cache)
+        self.assertTrue(other.diff_stats(commitid) is stats)
+
+    def test_changed_paths(self):
+        """ Test the pygit2_utils.GitRepo().changed_paths returning the
+        paths changed between two revisions
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        # Fails: revision invalid
+        self.assertRaises(
+            KeyError,
+            repo.changed_paths,
+            'HEAD',
+            'f05c03a2054f2d203bb',
+        )
+
+        first = repo.repository.revparse_single('HEAD').oid.hex
+        self.add_subdirectory()
+        second = repo.repository.revparse_single('HEAD').oid.hex
+        repo.commit_contents(
+            'Some changes',
+            {
+                'pkg/lib/mod': b'changed',
+                'pkg/setup': None,
+                'sources': b'changed',
+                '.gitignore': None,
+                '.gitignore/foo': b'foo',
+            }
+        )
+
+        self.assertEqual(
+            repo.changed_paths(first, second),
+            [('pkg/lib/mod', 'A'), ('pkg/setup', 'A')])
+        self.assertEqual(
+            repo.changed_paths(second, 'HEAD'),
+            [
+                ('.gitignore', 'D'),
+                ('.gitignore/foo', 'A'),
+                ('pkg/lib/mod', 'M'),
+                ('pkg/setup', 'D'),
+                ('sources', 'M'),
+            ]
+        )
+        self.assertEqual(
+            repo.changed_paths(second, 'HEAD', pathspec='pkg/lib'),
+            [('pkg/lib/mod', 'M')])
+        self.assertEqual(
+            repo.changed_paths(
+                second, 'HEAD', pathspec=['sources', 'pkg/setup', 'foo']),
+            [('pkg/setup', 'D'), ('sources', 'M')])
+        self.assertEqual(repo.changed_paths('HEAD', 'master'), [])
+
+    def test_log(self):
+        """ Test the pygit2_utils.GitRepo().log method returning pages of
+        the history
+        """
+        self.setup_git_repo()
+        self.add_commits(n=3)
+        self.add_subdirectory()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        # Fails: order invalid
+        self.assertRaises(ValueError, repo.log, order='foo')
+        # Fails: revision invalid
+        self.assertRaises(KeyError, repo.log, 'foo')
+
+        repo.commit_contents(
+            'Change pkg', {'pkg/setup': b'changed'},
+            username='bar', useremail='bar@foo.com')
+
+        # All the commits are made within the same second, so only the
+        # topological order is predictable
+        log = repo.log(order='topo')
+        self.assertEqual(
+            [commit.subject for commit in log],
+            [
+                'Change pkg',
+                'Add the pkg sub-directory',
+                'Add commit 2 out of 3',
+                'Add commit 1 out of 3',
+                'Add commit 0 out of 3',
+                'Add basic file required',
+            ]
+        )
+        head = repo.repository.revparse_single('HEAD')
+        self.assertEqual(log[0].oid, head.oid.hex)
+        self.assertEqual(log[0].author_name, 'bar')
+        self.assertEqual(log[0].author_email, 'bar@foo.com')
+        self.assertEqual(log[0].commit_time, head.commit_time)
+        self.assertEqual(log[0].parents, [log[1].oid])
+        self.assertEqual(log[-1].parents, [])
+
+        self.assertEqual(
+            [commit.subject
+             for commit in repo.log(offset=2, limit=2, order='topo')],
+            ['Add commit 2 out of 3', 'Add commit 1 out of 3'])
+        # Cursor pagination
+        page = repo.log(limit=2, order='topo')
+        pages = [[commit.subject for commit in page]]
+        while page.cursor is not None:
+            page = repo.log(after=page.cursor, limit=2, order='topo')
+            pages.append([commit.subject for commit in page])
+        self.assertEqual(
+            pages,
+            [
+                ['Change pkg', 'Add the pkg sub-directory'],
+                ['Add commit 2 out of 3', 'Add commit 1 out of 3'],
+                ['Add commit 0 out of 3', 'Add basic file required'],
+            ]
+        )
+        self.assertEqual(repo.log().cursor, None)
+        page = repo.log(path='pkg', limit=1, order='topo')
+        self.assertEqual(
+            [commit.subject
+             for commit in repo.log(
+                 path='pkg', after=page.cursor, order='topo')],
+            ['Add the pkg sub-directory'])
+        self.assertEqual(
+            sorted(commit.oid for commit in repo.log(log[2].oid)),
+            sorted(commit.oid for commit in log[2:]))
+
+        self.assertEqual(
+            [commit.subject for commit in repo.log(path='pkg', order='topo')],
+            ['Change pkg', 'Add the pkg sub-directory'])
+        self.assertEqual(
+            [commit.subject for commit in repo.log(path='pkg/lib/mod')],
+            ['Add the pkg sub-directory'])
+        self.assertEqual(
+            [commit.subject
+             for commit in repo.log(
+                 path='sources', offset=1, limit=2, order='topo')],
+            ['Add commit 1 out of 3', 'Add commit 0 out of 3'])
+        self.assertEqual(repo.log(path='foo'), [])
+
+        self.assertEqual(
+            [commit.subject for commit in repo.log(author='bar@foo')],
+            ['Change pkg'])
+
+        self.assertEqual(repo.log(since=head.commit_time + 10), [])
+        self.assertEqual(repo.log(until=head.commit_time - 3600 * 24), [])
+        self.assertEqual(len(repo.log(until=head.commit_time)), 6)
+
+    def test_log_cursor(self):
+        """ Test the pygit2_utils.GitRepo().log method resuming the walk
+        from the cursor of the previous page in a history with merges
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        repo_obj = pygit2.Repository(repo_path)
+        tree = repo_obj.revparse_single('HEAD').tree.oid
+        start = repo_obj.revparse_single('HEAD').commit_time
+
+        def _commit(message, parents, offset):
+            author = pygit2.Signature(
+                'Alice Author', 'alice@authors.tld', start + offset, 0)
+            return repo_obj.create_commit(
+                None, author, author, message, tree, parents)
+
+        base = _commit('base', [repo_obj.head.target], 10)
+        master = _commit('m1', [base], 20)
+        feature = _commit('feat', [base], 30)
+        merge = _commit('merge', [master, feature], 40)
+
+        log = repo.log(merge.hex)
+        self.assertEqual(
+            [commit.subject for commit in log],
+            ['merge', 'feat', 'm1', 'base', 'Add basic file required'])
+
+        page = repo.log(merge.hex, limit=2)
+        self.assertEqual(
+            [commit.subject for commit in page], ['merge', 'feat'])
+        self.assertEqual(page.cursor, sorted([master.hex, base.hex]))
+        page = repo.log(after=page.cursor, limit=2)
+        self.assertEqual([commit.subject for commit in page], ['m1', 'base'])
+        page = repo.log(after=page.cursor, limit=2)
+        self.assertEqual(
+            [commit.subject for commit in page], ['Add basic file required'])
+        self.assertEqual(page.cursor, None)
+
+    def test_reachability(self):
+        """ Test the pygit2_utils.GitRepo().is_ancestor, merge_base and
+        branches_containing methods, with and without the commit graph
+        """
+        self.setup_git_repo()
+        root = pygit2.Repository(os.path.join(
+            self.gitroot, 'test_repo')).head.target.hex
+        merge = self.add_merge_commit().hex
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        graph_path = os.path.join(
+            repo_path, '.git', 'pygit2_utils-commit-graph')
+
+        for commit_graph in [False, True]:
+            repo = pygit2_utils.GitRepo(
+                repo_path, commit_graph=commit_graph)
+            feature = repo.repository.revparse_single('feature').oid.hex
+            master = repo.repository.revparse_single('%s^1' % merge).oid.hex
+            base = repo.repository.revparse_single('feature^').oid.hex
+
+            # Fails: commit invalid
+            self.assertRaises(KeyError, repo.is_ancestor, 'foo', 'HEAD')
+
+            self.assertTrue(repo.is_ancestor(feature, merge))
+            self.assertTrue(repo.is_ancestor(root, 'feature'))
+            self.assertTrue(repo.is_ancestor(merge, merge))
+            self.assertFalse(repo.is_ancestor(merge, feature))
+            self.assertFalse(repo.is_ancestor(master, feature))
+
+            self.assertEqual(repo.merge_base(master, feature).hex, base)
+            self.assertEqual(repo.merge_base('feature', merge).hex, feature)
+            self.assertEqual(repo.merge_base(root, root).hex, root)
+
+            self.assertEqual(
+                repo.branches_containing(feature), ['feature', 'master'])
+            self.assertEqual(repo.branches_containing(merge), ['master'])
+            self.assertEqual(
+                repo.branches_containing(root, status='all'),
+                ['feature', 'master', 'origin/master'])
+
+        # The commit graph is stored on disk and updated as needed
+        self.assertTrue(os.path.exists(graph_path))
+        self.assertEqual(len(repo.commit_graph), 5)
+
+        repo = pygit2_utils.GitRepo(repo_path, commit_graph=True)
+        self.assertEqual(len(repo.commit_graph), 5)
+        commitid = repo.commit_contents('New commit', {'foo': b'foo'})
+        self.assertTrue(repo.is_ancestor(merge, commitid.hex))
+        self.assertEqual(len(repo.commit_graph), 6)
+        self.assertEqual(
+            len(pygit2_utils.CommitGraph(graph_path)), 6)
+
+        # The file is left untouched while someone else holds its lock
+        with open(graph_path + '.lock', 'w'):
+            pass
+        commitid = repo.commit_contents('Locked commit', {'foo': b'bar'})
+        self.assertTrue(repo.is_ancestor(merge, commitid.hex))
+        self.assertEqual(len(repo.commit_graph), 7)
+        self.assertEqual(
+            len(pygit2_utils.CommitGraph(graph_path)), 6)
+        os.unlink(graph_path + '.lock')
+        # Written with the next commit added
+        newid = repo.commit_contents('Unlocked commit', {'foo': b'baz'})
+        self.assertTrue(repo.is_ancestor(commitid.hex, newid.hex))
+        graph = pygit2_utils.CommitGraph(graph_path)
+        self.assertEqual(len(graph), 8)
+        self.assertEqual(
+            graph.raw_oid(graph.parents(graph.position(commitid))[0]),
+            repo.repository[commitid].parent_ids[0].raw)
+        self.assertFalse(os.path.exists(graph_path + '.lock'))
+
+        # A record partially written is replaced by the next ones
+        with open(graph_path, 'ab') as stream:
+            stream.write(b'0123456789')
+        repo = pygit2_utils.GitRepo(repo_path, commit_graph=True)
+        newid = repo.commit_contents('After junk', {'foo': b'junk'})
+        self.assertTrue(repo.is_ancestor(merge, newid.hex))
+        graph = pygit2_utils.CommitGraph(graph_path)
+        self.assertEqual(len(graph), 9)
+        self.assertEqual(
+            os.path.getsize(graph_path), repo.commit_graph._size)
+
+        # So is a file which is not an index
+        with open(graph_path, 'wb') as stream:
+            stream.write(b'not an index')
+        repo = pygit2_utils.GitRepo(repo_path, commit_graph=True)
+        self.assertTrue(repo.is_ancestor(merge, newid.hex))
+        self.assertEqual(len(pygit2_utils.CommitGraph(graph_path)), 9)
+
+        # Unrelated histories have no merge base
+        orphan = repo.commit_contents('Orphan', {'foo': b'foo'}, branch=None)
+        self.assertEqual(repo.merge_base(orphan.hex, merge), None)
+        self.assertFalse(repo.is_ancestor(orphan.hex, merge))
+
+    def test_branch_divergence(self):
+        """ Test the pygit2_utils.GitRepo().branch_divergence method
+        returning how many commits each branch is ahead and behind, with and
+        without the commit graph
+        """
+        self.setup_git_repo()
+        merge = self.add_merge_commit().hex
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        for commit_graph in [False, True]:
+            repo = pygit2_utils.GitRepo(
+                repo_path, commit_graph=commit_graph)
+
+            # Fails: commit invalid
+            self.assertRaises(KeyError, repo.branch_divergence, 'foo')
+
+            divergence = repo.branch_divergence()
+            self.assertEqual(
+                divergence, {'feature': None, 'master': (4, 0)})
+
+            divergence = repo.branch_divergence(base='feature')
+            self.assertEqual(
+                divergence, {'feature': (0, 0), 'master': (2, 0)})
+
+            divergence = repo.branch_divergence(base='%s^1' % merge)
+            self.assertEqual(
+                divergence, {'feature': (1, 1), 'master': (2, 0)})
+
+        # The results are cached by the commits compared
+        self.assertEqual(len(repo._divergence_cache), 5)
+        repo.commit_contents('New commit', {'foo': b'foo'})
+        divergence = repo.branch_divergence(base='%s^1' % merge)
+        self.assertEqual(
+            divergence, {'feature': (1, 1), 'master': (3, 0)})
+        self.assertEqual(len(repo._divergence_cache), 6)
+
     def test_list_branches(self):
         """ Test the pygit2_utils.GitRepo().list_branches method returning
         the list of branches.
@@ -418,6 +1499,51 @@ index e69de29..fa457ba 100644
         branches = repo.list_branches('remote')
         self.assertEqual(sorted(branches), ['origin/master'])
 
+    def test_list_branches_with_tips(self):
+        """ Test the pygit2_utils.GitRepo().list_branches method returning
+        a sorted page of branches with the commit at their tip.
+        """
+        self.setup_git_repo()
+        self.add_branches()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        head = repo.repository.head.target.hex
+
+        # Make foo1 the most recently committed branch
+        author = pygit2.Signature(
+            'Bob Author', 'bob@authors.tld', int(time.time()) + 3600, 0)
+        parent = repo.repository[head]
+        newer = repo.repository.create_commit(
+            'refs/heads/foo1', author, author, 'Newer commit', parent.tree.oid,
+            [parent.oid]).hex
+
+        # Fails: sort invalid
+        self.assertRaises(ValueError, repo.list_branches, sort='foo')
+
+        branches = repo.list_branches(sort='committerdate')
+        self.assertEqual(branches, ['foo1', 'foo0', 'master', 'origin/master'])
+
+        branches = repo.list_branches(sort='name', offset=1, limit=2)
+        self.assertEqual(branches, ['foo1', 'master'])
+
+        branches = repo.list_branches(
+            'local', with_tips=True, sort='committerdate', limit=2)
+        self.assertEqual(len(branches), 2)
+        self.assertEqual(branches[0], pygit2_utils.BranchRecord(
+            'foo1', newer, author.time, 'Bob Author', 'bob@authors.tld',
+            None))
+        self.assertEqual(branches[1].name, 'foo0')
+        self.assertEqual(branches[1].target, head)
+        self.assertEqual(branches[1].upstream, None)
+
+        branches = repo.list_branches(with_tips=True, sort='name', offset=2)
+        self.assertEqual(
+            [(branch.name, branch.target, branch.upstream)
+             for branch in branches],
+            [('master', head, 'origin/master'),
+             ('origin/master', head, None)])
+
     def test_list_tags(self):
         """ Test the pygit2_utils.GitRepo().list_tags method returning the
         list of tags. present in the repo
@@ -435,6 +1561,38 @@ index e69de29..fa457ba 100644
         tags = repo.list_tags()
         self.assertEqual(tags, ['v0', 'v1'])
 
+        head = repo.repository.revparse_single('HEAD')
+        tags = repo.list_tags(peeled=True)
+        self.assertEqual(
+            tags,
+            [('v0', head.oid.hex), ('v1', head.parents[0].oid.hex)])
+
+        # Packed tags are peeled using the packed-refs file only
+        tag_oid = repo.repository.lookup_reference('refs/tags/v1').target.hex
+        with open(os.path.join(
+                repo.repository.path, 'packed-refs'), 'w') as stream:
+            stream.write(
+                '# pack-refs with: peeled fully-peeled sorted \n'
+                '%s refs/heads/packed\n'
+                '%s refs/tags/packed/light\n'
+                '%s refs/tags/packed/missing\n'
+                '^%s\n'
+                '%s refs/tags/v1\n'
+                '^%s\n' % (
+                    head.oid.hex, head.oid.hex, '0' * 40, head.oid.hex,
+                    tag_oid, head.parents[0].oid.hex))
+        os.unlink(os.path.join(repo.repository.path, 'refs', 'tags', 'v1'))
+
+        tags = repo.list_tags()
+        self.assertEqual(tags, ['packed/light', 'packed/missing', 'v0', 'v1'])
+        tags = repo.list_tags(peeled=True)
+        self.assertEqual(
+            tags,
+            [('packed/light', head.oid.hex),
+             ('packed/missing', head.oid.hex),
+             ('v0', head.oid.hex),
+             ('v1', head.parents[0].oid.hex)])
+
     def test_tag(self):
         """ Test the pygit2_utils.GitRepo().tag method used to tag a
         specific commit
@@ -481,6 +1639,89 @@ index e69de29..fa457ba 100644
         tags = repo.list_tags()
         self.assertEqual(tags, ['test1', 'test2', 'test3'])
 
+    def test_tag_many(self):
+        """ Test the pygit2_utils.GitRepo().tag_many method used to tag
+        several commits at once
+        """
+        self.setup_git_repo()
+        self.add_commits(n=4)
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        repo_obj = pygit2.Repository(repo_path)
+        commits = [
+            repo_obj.revparse_single('HEAD~%s' % i).oid.hex
+            for i in range(3)]
+
+        # Fails: invalid or duplicated tag names
+        self.assertRaises(
+            ValueError, repo.tag_many, [('foo bar', commits[0], None)])
+        self.assertRaises(
+            ValueError, repo.tag_many,
+            [('v1', commits[0], None), ('v1', commits[1], None)])
+
+        # Fails: commit invalid
+        self.assertRaises(KeyError, repo.tag_many, [('v1', 'foo', None)])
+
+        tagids = repo.tag_many([
+            ('v2', commits[0], 'Version 2\n'),
+            ('release/v1', commits[1], None),
+        ])
+        self.assertEqual(len(tagids), 2)
+        tagobj = repo_obj.get(tagids[0])
+        self.assertEqual(tagobj.name, 'v2')
+        self.assertEqual(tagobj.target.hex, commits[0])
+        self.assertEqual(tagobj.message, 'Version 2\n')
+        self.assertEqual(tagobj.tagger.name, 'foo')
+        self.assertEqual(tagobj.tagger.email, 'foo@bar.com')
+        self.assertEqual(repo_obj.get(tagids[1]).message, '')
+
+        # The tags are packed, no loose reference is written
+        self.assertFalse(os.path.exists(
+            os.path.join(repo_path, '.git', 'refs', 'tags', 'v2')))
+        self.assertEqual(
+            repo_obj.lookup_reference('refs/tags/v2').target, tagids[0])
+        self.assertEqual(
+            repo.list_tags(peeled=True),
+            [('release/v1', commits[1]), ('v2', commits[0])])
+
+        tagids = repo.tag_many(
+            [('light', commits[2], 'ignored')], lightweight=True)
+        self.assertEqual([tagid.hex for tagid in tagids], [commits[2]])
+        self.assertEqual(
+            repo_obj.lookup_reference('refs/tags/light').target.hex,
+            commits[2])
+
+        # Fails: a tag already exists, nothing is written
+        repo.tag('loose', commits[2])
+        objects = len(list(repo_obj))
+        self.assertRaises(
+            pygit2_utils.exceptions.ReferenceExistsError,
+            repo.tag_many,
+            [('v3', commits[2], None), ('loose', commits[2], None)])
+        self.assertRaises(
+            pygit2_utils.exceptions.ReferenceExistsError,
+            repo.tag_many, [('v2', commits[2], None)], lightweight=True)
+        self.assertEqual(
+            repo.list_tags(), ['light', 'loose', 'release/v1', 'v2'])
+        self.assertEqual(len(list(repo_obj)), objects)
+
+        # Fails: the packed-refs file is being written by someone else,
+        # whose lock is left in place
+        lock_path = os.path.join(repo_obj.path, 'packed-refs.lock')
+        with open(lock_path, 'w'):
+            pass
+        self.assertRaises(
+            pygit2_utils.exceptions.ReferenceChangedError,
+            repo.tag_many, [('v3', commits[2], None)])
+        self.assertTrue(os.path.exists(lock_path))
+        self.assertEqual(len(list(repo_obj)), objects)
+        os.unlink(lock_path)
+
+        repo.tag_many([('v3', commits[2], None)])
+        self.assertFalse(os.path.exists(lock_path))
+        self.assertEqual(len(list(repo_obj)), objects + 1)
+
     def test_checkout(self):
         """ Test the pygit2_utils.GitRepo().checkout method used to change
         branch
@@ -699,6 +1940,71 @@ index e69de29..94921de 100644
 
         self.assertEqual(patch, exp)
 
+    def test_iter_patches(self):
+        """ Test the pygit2_utils.GitRepo().iter_patches and write_patches
+        methods returning the patches one commit at a time
+        """
+        self.setup_git_repo()
+        self.add_commits()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        repo_obj = pygit2.Repository(repo_path)
+
+        commitids = [repo_obj.revparse_single('HEAD').oid.hex]
+        commitids.append(repo_obj.revparse_single('HEAD^').oid.hex)
+
+        patches = repo.iter_patches(commitids)
+        patch = next(patches)
+        self.assertTrue(
+            patch.startswith('From %s Mon Sep 17' % commitids[0]))
+        self.assertTrue(
+            'Subject: [PATCH 1/2] Add commit 1 out of 2' in patch)
+        patch = next(patches)
+        self.assertTrue(
+            patch.startswith('From %s Mon Sep 17' % commitids[1]))
+        self.assertTrue(
+            'Subject: [PATCH 2/2] Add commit 0 out of 2' in patch)
+        self.assertRaises(StopIteration, next, patches)
+
+        stream = io.StringIO()
+        repo.write_patches(commitids, stream)
+        self.assertEqual(stream.getvalue(), repo.get_patch(commitids))
+
+    def test_get_patch_workers(self):
+        """ Test the pygit2_utils.GitRepo().get_patch computing the diffs
+        in parallel
+        """
+        self.setup_git_repo()
+        self.add_commits(n=10)
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        commitids = [
+            commit.oid.hex
+            for commit in repo.repository.walk(
+                repo.repository.head.target, pygit2.GIT_SORT_TIME)
+        ]
+
+        patch = repo.get_patch(commitids)
+        self.assertEqual(repo.get_patch(commitids, workers=3), patch)
+        self.assertTrue('[PATCH 11/11]' in patch)
+
+        # Fails: hash invalid
+        self.assertRaises(
+            KeyError,
+            repo.get_patch,
+            commitids + ['foo'],
+            workers=2,
+        )
+
+        if sys.version_info >= (3, 2):
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                self.assertEqual(
+                    repo.get_patch(commitids, executor=executor), patch)
+
     def test_merge(self):
         """ Test the pygit2_utils.GitRepo().merge method used to merge a
         branch from a repo to another
@@ -868,6 +2174,246 @@ index e69de29..94921de 100644
         )
 
 
+    def test_merge_commits(self):
+        """ Test the pygit2_utils.GitRepo().merge_commits method merging
+        commits in memory, in a bare repo
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo.git')
+        repo_obj = pygit2.Repository(repo_path)
+        repo_obj.config['user.name'] = 'foo'
+        repo_obj.config['user.email'] = 'foo@bar.com'
+
+        repo = pygit2_utils.GitRepo(repo_path)
+        base = repo.repository.revparse_single('master').oid
+
+        feature = repo.commit_contents(
+            'Feature', {'feature': b'feature\n'}, parent='master',
+            branch='feature')
+        conflict = repo.commit_contents(
+            'Conflict', {'sources': b'conflict\n'}, parent='master',
+            branch='conflict')
+        master = repo.commit_contents('Master', {'sources': b'master\n'})
+
+        # Fails: commit invalid
+        self.assertRaises(KeyError, repo.merge_commits, 'master', 'foo')
+
+        # Fails: nothing to merge
+        self.assertRaises(
+            pygit2_utils.exceptions.NothingToMergeError,
+            repo.merge_commits, 'master', base.hex)
+
+        # Fails: conflict, nothing is changed
+        self.assertRaises(
+            pygit2_utils.exceptions.MergeConflictsError,
+            repo.merge_commits, 'master', 'conflict',
+            target_ref='master')
+        self.assertEqual(repo.head_of_branch('master').oid, master)
+
+        # Fails: the target does not point to ours
+        self.assertRaises(
+            pygit2_utils.exceptions.ReferenceChangedError,
+            repo.merge_commits, 'feature', 'master',
+            target_ref='master')
+
+        # Merge without moving any reference
+        sha = repo.merge_commits('master', 'feature')
+        commit = repo.repository[sha]
+        self.assertEqual(commit.parent_ids, [master, feature])
+        self.assertEqual(commit.message, 'Merge feature into master')
+        self.assertEqual(commit.author.name, 'foo')
+        self.assertEqual(
+            sorted(entry.name for entry in commit.tree),
+            ['.gitignore', 'feature', 'sources'])
+        self.assertEqual(repo.head_of_branch('master').oid, master)
+
+        # Merge moving the branch
+        sha = repo.merge_commits(
+            'master', 'feature', target_ref='refs/heads/master',
+            message='Merge PR', username='bar', useremail='bar@foo.com')
+        commit = repo.repository[sha]
+        self.assertEqual(commit.message, 'Merge PR')
+        self.assertEqual(commit.author.name, 'bar')
+        self.assertEqual(repo.head_of_branch('master').oid, sha)
+
+        # Fast-forward
+        repo.repository.create_branch('old', repo.repository[base])
+        sha = repo.merge_commits('old', 'feature', target_ref='old')
+        self.assertEqual(sha, feature)
+        self.assertEqual(repo.head_of_branch('old').oid, feature)
+        self.assertEqual(repo.head_of_branch('conflict').oid, conflict)
+
+
+    def test_can_merge(self):
+        """ Test the pygit2_utils.GitRepo().can_merge and can_merge_many
+        methods checking merges without changing the repo
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+        base = repo.repository.revparse_single('master').oid.hex
+
+        repo.commit_contents(
+            'Feature', {'feature': b'feature\n'}, parent='master',
+            branch='feature')
+        repo.commit_contents(
+            'Conflict', {'sources': b'conflict\n', 'feature': b'foo\n'},
+            parent='master', branch='conflict')
+        master = repo.commit_contents(
+            'Master', {'sources': b'master\n'}, branch='master')
+        status = repo.repository.status()
+
+        # Fails: commit invalid
+        self.assertRaises(KeyError, repo.can_merge, 'foo', 'master')
+
+        self.assertEqual(
+            repo.can_merge(base, 'master'),
+            pygit2_utils.MergeCheck('up-to-date', []))
+        self.assertEqual(
+            repo.can_merge('master', base),
+            pygit2_utils.MergeCheck('fast-forward', []))
+        self.assertEqual(
+            repo.can_merge('feature', 'master'),
+            pygit2_utils.MergeCheck('clean', []))
+        self.assertEqual(
+            repo.can_merge('conflict', 'master'),
+            pygit2_utils.MergeCheck('conflicted', ['sources']))
+        self.assertEqual(
+            repo.can_merge('conflict', 'feature'),
+            pygit2_utils.MergeCheck('conflicted', ['feature']))
+
+        # Nothing was changed and the results are cached
+        self.assertEqual(repo.head_of_branch('master').oid, master)
+        self.assertEqual(repo.repository.status(), status)
+        self.assertEqual(len(repo._merge_cache), 5)
+
+        expected = {
+            'feature': pygit2_utils.MergeCheck('clean', []),
+            'conflict': pygit2_utils.MergeCheck('conflicted', ['sources']),
+            base: pygit2_utils.MergeCheck('up-to-date', []),
+        }
+        for kwargs in [{}, {'workers': 2}]:
+            repo._merge_cache.clear()
+            checks = repo.can_merge_many(
+                ['feature', 'conflict', base], 'master', **kwargs)
+            self.assertEqual(checks, expected)
+
+
+    def test_cherry_pick(self):
+        """ Test the pygit2_utils.GitRepo().cherry_pick method applying a
+        commit in memory, in a bare repo
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo.git')
+        repo_obj = pygit2.Repository(repo_path)
+        repo_obj.config['user.name'] = 'foo'
+        repo_obj.config['user.email'] = 'foo@bar.com'
+
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        feature = repo.commit_contents(
+            'Feature', {'feature': b'feature\n'}, parent='master',
+            branch='feature', username='bar', useremail='bar@foo.com')
+        conflict = repo.commit_contents(
+            'Conflict', {'sources': b'conflict\n'}, parent='master',
+            branch='conflict', username='bar', useremail='bar@foo.com')
+        master = repo.commit_contents('Master', {'sources': b'master\n'})
+
+        # Fails: commit invalid
+        self.assertRaises(KeyError, repo.cherry_pick, 'foo', 'master')
+
+        # Fails: conflict
+        self.assertRaises(
+            pygit2_utils.exceptions.MergeConflictsError,
+            repo.cherry_pick, 'conflict', 'master')
+
+        # Fails: the changes are already there
+        self.assertRaises(
+            pygit2_utils.exceptions.NothingToMergeError,
+            repo.cherry_pick, 'feature', 'feature')
+
+        sha = repo.cherry_pick('feature', 'master', target_ref='master')
+        commit = repo.repository[sha]
+        self.assertEqual(commit.parent_ids, [master])
+        self.assertEqual(commit.message, 'Feature')
+        self.assertEqual(commit.author.name, 'bar')
+        self.assertEqual(commit.committer.name, 'foo')
+        self.assertEqual(
+            commit.tree['feature'].oid,
+            repo.repository[feature].tree['feature'].oid)
+        self.assertEqual(
+            commit.tree['sources'].oid,
+            repo.repository[master].tree['sources'].oid)
+        self.assertEqual(repo.head_of_branch('master').oid, sha)
+        self.assertEqual(repo.head_of_branch('conflict').oid, conflict)
+
+    def test_rebase(self):
+        """ Test the pygit2_utils.GitRepo().rebase method replaying the
+        commits of a branch in memory
+        """
+        self.setup_git_repo()
+
+        repo_path = os.path.join(self.gitroot, 'test_repo')
+        repo = pygit2_utils.GitRepo(repo_path)
+
+        with repo.commit_batch(
+                branch='feature', parent='master', username='bar',
+                useremail='bar@foo.com') as batch:
+            first = batch.commit('First', {'feature': b'1\n'})
+            conflict = batch.commit('Conflict', {'sources': b'feature\n'})
+            third = batch.commit('Third', {'feature': b'3\n'})
+        master = repo.commit_contents('Master', {'sources': b'master\n'})
+        status = repo.repository.status()
+
+        # Fails: branch invalid
+        self.assertRaises(
+            pygit2_utils.exceptions.NoSuchBranchError,
+            repo.rebase, 'foo', 'master')
+
+        # Fails: conflict, the branch is left as it is
+        self.assertRaises(
+            pygit2_utils.exceptions.MergeConflictsError,
+            repo.rebase, 'feature', 'master')
+        self.assertEqual(repo.head_of_branch('feature').oid, third)
+
+        result = repo.rebase('feature', 'master', stop_on_conflict=False)
+        self.assertEqual(
+            [old for old, new in result.commits], [first, third])
+        self.assertEqual(result.skipped, [conflict])
+        self.assertEqual(repo.head_of_branch('feature').oid, result.tip)
+
+        tip = repo.repository[result.tip]
+        self.assertEqual(tip.message, 'Third')
+        self.assertEqual(tip.author.name, 'bar')
+        self.assertEqual(tip.committer.name, 'foo')
+        self.assertEqual(tip.parent_ids, [result.commits[0][1]])
+        self.assertEqual(
+            repo.repository[result.commits[0][1]].parent_ids, [master])
+        self.assertEqual(
+            repo.repository[tip.tree['feature'].oid].data, b'3\n')
+        self.assertEqual(
+            repo.repository[tip.tree['sources'].oid].data, b'master\n')
+
+        # Nothing left to rebase
+        self.assertEqual(
+            repo.rebase('feature', 'master'),
+            pygit2_utils.RebaseResult(result.tip, [], []))
+
+        # The branch is fast-forwarded when it has nothing of its own
+        repo.repository.create_branch('old', repo.repository[master])
+        result = repo.rebase('refs/heads/old', 'feature')
+        self.assertEqual(result.tip, repo.head_of_branch('feature').oid)
+        self.assertEqual(result.commits, [])
+        self.assertEqual(result.skipped, [])
+        self.assertEqual(repo.head_of_branch('old').oid, result.tip)
+
+        # Neither the index nor the working tree were used
+        self.assertEqual(repo.repository.status(), status)
+
+
 if __name__ == '__main__':
     SUITE = unittest.TestLoader().loadTestsFromTestCase(ScmTests)
     unittest.TextTestRunner(verbosity=2).run(SUITE)